@@ -2,15 +2,134 @@ import os
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime
 
-from models import setup_db, Artist, Album
+from models import setup_db, db, Artist, Album, get_stats
 from auth import AuthError, requires_auth
+from pagination import MAX_PAGE_SIZE, get_page_args, paginate
+from streaming import wants_stream, stream_query
+from cache import setup_cache, get_cache, cached
+from replicas import setup_replicas
+from profiling import setup_profiling
+from ratelimit import setup_rate_limits
+from filters import artist_filters, album_filters
+from fieldsets import artist_formatter, album_formatter, wants_compact
+from serialization import JSONProvider, TupleRows
+from search import search_terms, search_catalog, load_results
+
+# Largest batch accepted by the bulk endpoints
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+
+
+def get_bulk_items(key):
+    """Returns the list under `key` in the JSON body, aborting with 400 if invalid
+    """
+    body = request.get_json(silent=True)
+    items = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items or len(items) > BULK_MAX_ITEMS:
+        abort(400)
+    return items
+
+
+def validate_artist(item):
+    """Returns (row, error) for one artist in a bulk request
+    """
+    if not isinstance(item, dict):
+        return None, 'artist must be an object'
+    row = {key: item.get(key) for key in ('name', 'age', 'genre', 'country')}
+    if not all(row.values()):
+        return None, 'name, age, genre and country are required'
+    if not isinstance(row['age'], int):
+        return None, 'age must be an integer'
+    return row, None
+
+
+def validate_album(item):
+    """Returns (row, error) for one album in a bulk request
+    """
+    if not isinstance(item, dict):
+        return None, 'album must be an object'
+    row = {key: item.get(key) for key in ('title', 'release_date', 'genre', 'artist_id')}
+    if not all(row.values()):
+        return None, 'title, release_date, genre and artist_id are required'
+    row['track_count'] = item.get('track_count', 10)
+    if not isinstance(row['artist_id'], int) or not isinstance(row['track_count'], int):
+        return None, 'artist_id and track_count must be integers'
+    try:
+        row['release_date'] = datetime.strptime(row['release_date'], '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None, 'release_date must be YYYY-MM-DD'
+    return row, None
+
+
+def get_bulk_criteria(model, filter_fields):
+    """Builds WHERE criteria from {"ids": [...]} or {"filter": {...}} in the JSON body
+
+    Filters are equality matches on `filter_fields`. Aborts with 400 unless
+    exactly one of ids/filter is given and it is non-empty.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or ('ids' in body) == ('filter' in body):
+        abort(400)
+
+    if 'ids' in body:
+        ids = body['ids']
+        if (not isinstance(ids, list) or not ids or len(ids) > BULK_MAX_ITEMS or
+                not all(isinstance(id, int) for id in ids)):
+            abort(400)
+        return [model.id.in_(ids)]
+
+    filters = body['filter']
+    if not isinstance(filters, dict) or not filters or not set(filters) <= set(filter_fields):
+        abort(400)
+    return [getattr(model, field) == value for field, value in filters.items()]
+
+
+ARTIST_CHANGES = {'name': str, 'age': int, 'genre': str, 'country': str}
+ALBUM_CHANGES = {'title': str, 'release_date': str, 'genre': str, 'track_count': int, 'artist_id': int}
+
+
+def get_bulk_changes(fields):
+    """Returns the "changes" object of a bulk PATCH body
+
+    `fields` maps each changeable column to its JSON type; as in the bulk
+    inserts, integers must be integers and strings non-empty. Aborts with
+    400 on any other field or value.
+    """
+    body = request.get_json(silent=True)
+    changes = body.get('changes') if isinstance(body, dict) else None
+    if not isinstance(changes, dict) or not changes or not set(changes) <= set(fields):
+        abort(400)
+    for field, value in changes.items():
+        kind = fields[field]
+        if isinstance(value, bool) or not isinstance(value, kind) or (kind is str and not value):
+            abort(400)
+    return dict(changes)
+
+
+def bulk_errors(errors):
+    return jsonify({
+        "success": False,
+        "error": 400,
+        "message": "bad request",
+        "errors": errors
+    }), 400
+
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.json = JSONProvider(app)
+    app.config['INTERNAL_ENDPOINTS'] = os.environ.get('INTERNAL_ENDPOINTS') == '1'
+    if test_config:
+        app.config.update(test_config)
     setup_db(app)
+    setup_replicas(app)
+    setup_cache(app)
+    setup_profiling(app)
+    setup_rate_limits(app)
     CORS(app)
 
     # CORS Headers
@@ -29,44 +148,201 @@ def create_app(test_config=None):
             'version': '1.0.0'
         })
 
+    # Internal endpoints (only registered when INTERNAL_ENDPOINTS=1)
+    if app.config['INTERNAL_ENDPOINTS']:
+        @app.route('/internal/cache')
+        def cache_stats():
+            cache = get_cache()
+            return jsonify({
+                'success': True,
+                'response_cache': cache.stats() if cache is not None else None
+            })
+
+        @app.route('/internal/pool')
+        def pool_stats():
+            return jsonify({
+                'success': True,
+                'pool': app.extensions['pool_metrics'].snapshot()
+            })
+
+        @app.route('/internal/slow-queries')
+        def slow_queries():
+            return jsonify({
+                'success': True,
+                'slow_queries': app.extensions['slow_queries'].stats()
+            })
+
     # ROUTES
 
     '''
     GET /artists
     Public endpoint - requires 'get:artists' permission
+    Optional ?genre=&country=&min_age=&max_age=&name_prefix= filters
+    Optional ?fields=&include=&format=compact for sparse/compact rows
+    Optional ?limit=&cursor= for keyset pagination
+    Optional ?stream=1[&format=ndjson] for full exports
     '''
     @app.route('/artists')
     @requires_auth('get:artists')
+    @cached('artists', 'albums')
     def retrieve_artists(payload):
+        criteria = artist_filters()
+        formatter = artist_formatter()
+        if wants_stream():
+            query = Artist.query.options(*formatter.options()).filter(*criteria)
+            return stream_query(query.order_by(Artist.id), formatter, 'artists')
+
+        limit, after = get_page_args()
+        compact = wants_compact()
+        rows = TupleRows(formatter)
+        query = rows.query(criteria)
         try:
-            artists = Artist.query.order_by(Artist.id).all()
-            
-            return jsonify({
-                'success': True,
-                'artists': [artist.format() for artist in artists],
-                'total_artists': len(artists)
-            })
+            if limit is None:
+                artists = query.order_by(Artist.id).all()
+                return jsonify(dict(
+                    rows.encode('artists', artists, compact, criteria),
+                    success=True,
+                    total_artists=len(artists)
+                ))
+
+            artists, next_cursor = paginate(query, Artist.id, limit, after)
+            return jsonify(dict(
+                rows.encode('artists', artists, compact),
+                success=True,
+                total_artists=db.session.query(func.count(Artist.id)).filter(*criteria).scalar(),
+                next_cursor=next_cursor
+            ))
         except Exception:
             abort(422)
 
     '''
     GET /albums
     Public endpoint - requires 'get:albums' permission
+    Optional ?genre=&artist_id=&released_after=&released_before=&min_tracks=&max_tracks= filters
+    Optional ?fields=&include=&format=compact for sparse/compact rows
+    Optional ?limit=&cursor= for keyset pagination
+    Optional ?stream=1[&format=ndjson] for full exports
     '''
     @app.route('/albums')
     @requires_auth('get:albums')
+    @cached('albums', 'artists')
     def retrieve_albums(payload):
+        criteria = album_filters()
+        formatter = album_formatter()
+        if wants_stream():
+            query = Album.query.options(*formatter.options()).filter(*criteria)
+            return stream_query(query.order_by(Album.id), formatter, 'albums')
+
+        limit, after = get_page_args()
+        compact = wants_compact()
+        rows = TupleRows(formatter)
+        query = rows.query(criteria)
         try:
-            albums = Album.query.order_by(Album.id).all()
-            
+            if limit is None:
+                albums = query.order_by(Album.id).all()
+                return jsonify(dict(
+                    rows.encode('albums', albums, compact, criteria),
+                    success=True,
+                    total_albums=len(albums)
+                ))
+
+            albums, next_cursor = paginate(query, Album.id, limit, after)
+            return jsonify(dict(
+                rows.encode('albums', albums, compact),
+                success=True,
+                total_albums=db.session.query(func.count(Album.id)).filter(*criteria).scalar(),
+                next_cursor=next_cursor
+            ))
+        except Exception:
+            abort(422)
+
+    '''
+    GET /artists/<id>
+    Requires 'get:artists' permission
+    '''
+    @app.route('/artists/<int:artist_id>')
+    @requires_auth('get:artists')
+    @cached('artists', 'albums')
+    def retrieve_artist(payload, artist_id):
+        # Primary key lookup (identity map first), albums in one extra query
+        artist = db.session.get(Artist, artist_id, options=[selectinload(Artist.albums)])
+
+        if artist is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'artist': artist.format()
+        })
+
+    '''
+    GET /albums/<id>
+    Requires 'get:albums' permission
+    '''
+    @app.route('/albums/<int:album_id>')
+    @requires_auth('get:albums')
+    @cached('albums', 'artists')
+    def retrieve_album(payload, album_id):
+        album = db.session.get(Album, album_id, options=[joinedload(Album.artist_ref)])
+
+        if album is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'album': album.format()
+        })
+
+    '''
+    GET /search?q=
+    Requires 'get:artists' and 'get:albums' permissions
+    Ranked prefix search over artist names and album titles
+    Optional ?type=artists|albums, ?page= and ?limit=
+    '''
+    @app.route('/search')
+    @requires_auth(['get:artists', 'get:albums'])
+    @cached('artists', 'albums')
+    def search(payload):
+        terms = search_terms(request.args.get('q'))
+        kinds = request.args.get('type', 'artists,albums').split(',')
+        page = request.args.get('page', 1, type=int)
+        limit = min(request.args.get('limit', 20, type=int), MAX_PAGE_SIZE)
+        if not terms or not set(kinds) <= {'artists', 'albums'} or page < 1 or limit < 1:
+            abort(400)
+
+        try:
+            matches = search_catalog(terms, kinds, limit=limit + 1, offset=(page - 1) * limit)
+
             return jsonify({
                 'success': True,
-                'albums': [album.format() for album in albums],
-                'total_albums': len(albums)
+                'results': load_results(matches[:limit]),
+                'page': page,
+                'next_page': page + 1 if len(matches) > limit else None
             })
         except Exception:
             abort(422)
 
+    '''
+    GET /stats
+    Requires 'get:artists' and 'get:albums' permissions
+    Catalog counts read from the precomputed catalog_stats counters
+    '''
+    @app.route('/stats')
+    @requires_auth(['get:artists', 'get:albums'])
+    @cached('artists', 'albums', 'catalog_stats')
+    def catalog_stats(payload):
+        try:
+            stats = get_stats()
+            totals = stats['totals']
+
+            return jsonify(dict(
+                stats,
+                success=True,
+                albums_per_artist=round(totals['albums'] / totals['artists'], 2) if totals['artists'] else 0
+            ))
+        except Exception:
+            abort(422)
+
     '''
     DELETE /artists/<id>
     Requires 'delete:artists' permission
@@ -190,6 +466,172 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    '''
+    POST /artists/bulk
+    Requires 'post:artists' permission
+    Body: {"artists": [{name, age, genre, country}, ...]}
+    The batch is inserted in one transaction, or not at all if any item is invalid
+    '''
+    @app.route('/artists/bulk', methods=['POST'])
+    @requires_auth('post:artists')
+    def create_artists_bulk(payload):
+        rows, errors = [], []
+        for index, item in enumerate(get_bulk_items('artists')):
+            row, error = validate_artist(item)
+            if error:
+                errors.append({'index': index, 'message': error})
+            else:
+                rows.append(row)
+
+        if errors:
+            return bulk_errors(errors)
+
+        try:
+            Artist.bulk_insert(rows)
+
+            return jsonify({
+                'success': True,
+                'created': len(rows)
+            })
+
+        except Exception:
+            abort(422)
+
+    '''
+    POST /albums/bulk
+    Requires 'post:albums' permission
+    Body: {"albums": [{title, release_date, genre, track_count, artist_id}, ...]}
+    The batch is inserted in one transaction, or not at all if any item is invalid
+    '''
+    @app.route('/albums/bulk', methods=['POST'])
+    @requires_auth('post:albums')
+    def create_albums_bulk(payload):
+        rows, errors = [], []
+        for index, item in enumerate(get_bulk_items('albums')):
+            row, error = validate_album(item)
+            if error:
+                errors.append({'index': index, 'message': error})
+            else:
+                rows.append((index, row))
+
+        # All referenced artists are checked with a single query
+        artist_ids = {row['artist_id'] for _, row in rows}
+        existing = {artist_id for (artist_id,) in
+                    db.session.query(Artist.id).filter(Artist.id.in_(artist_ids))}
+        for index, row in rows:
+            if row['artist_id'] not in existing:
+                errors.append({'index': index, 'message': 'artist not found'})
+
+        if errors:
+            errors.sort(key=lambda error: error['index'])
+            return bulk_errors(errors)
+
+        try:
+            Album.bulk_insert([row for _, row in rows])
+
+            return jsonify({
+                'success': True,
+                'created': len(rows)
+            })
+
+        except Exception:
+            abort(422)
+
+    '''
+    PATCH /artists/bulk
+    Requires 'patch:artists' permission
+    Body: {"ids": [...]} or {"filter": {genre, country}}, plus {"changes": {...}}
+    '''
+    @app.route('/artists/bulk', methods=['PATCH'])
+    @requires_auth('patch:artists')
+    def modify_artists_bulk(payload):
+        criteria = get_bulk_criteria(Artist, ('genre', 'country'))
+        changes = get_bulk_changes(ARTIST_CHANGES)
+
+        try:
+            updated = Artist.bulk_update(criteria, changes)
+
+            return jsonify({
+                'success': True,
+                'updated': updated
+            })
+
+        except Exception:
+            abort(422)
+
+    '''
+    PATCH /albums/bulk
+    Requires 'patch:albums' permission
+    Body: {"ids": [...]} or {"filter": {genre, artist_id}}, plus {"changes": {...}}
+    '''
+    @app.route('/albums/bulk', methods=['PATCH'])
+    @requires_auth('patch:albums')
+    def modify_albums_bulk(payload):
+        criteria = get_bulk_criteria(Album, ('genre', 'artist_id'))
+        changes = get_bulk_changes(ALBUM_CHANGES)
+
+        if 'release_date' in changes:
+            try:
+                changes['release_date'] = datetime.strptime(changes['release_date'], '%Y-%m-%d')
+            except (TypeError, ValueError):
+                abort(400)
+        if 'artist_id' in changes and db.session.get(Artist, changes['artist_id']) is None:
+            abort(404)
+
+        try:
+            updated = Album.bulk_update(criteria, changes)
+
+            return jsonify({
+                'success': True,
+                'updated': updated
+            })
+
+        except Exception:
+            abort(422)
+
+    '''
+    DELETE /artists/bulk
+    Requires 'delete:artists' permission
+    Body: {"ids": [...]} or {"filter": {genre, country}}
+    The artists' albums are deleted with them
+    '''
+    @app.route('/artists/bulk', methods=['DELETE'])
+    @requires_auth('delete:artists')
+    def delete_artists_bulk(payload):
+        criteria = get_bulk_criteria(Artist, ('genre', 'country'))
+
+        try:
+            deleted = Artist.bulk_delete(criteria)
+
+            return jsonify({
+                'success': True,
+                'deleted': deleted
+            })
+
+        except Exception:
+            abort(422)
+
+    '''
+    DELETE /albums/bulk
+    Requires 'delete:albums' permission
+    Body: {"ids": [...]} or {"filter": {genre, artist_id}}
+    '''
+    @app.route('/albums/bulk', methods=['DELETE'])
+    @requires_auth('delete:albums')
+    def delete_albums_bulk(payload):
+        criteria = get_bulk_criteria(Album, ('genre', 'artist_id'))
+
+        try:
+            deleted = Album.bulk_delete(criteria)
+
+            return jsonify({
+                'success': True,
+                'deleted': deleted
+            })
+
+        except Exception:
+            abort(422)
+
     '''
     PATCH /artists/<id>
     Requires 'patch:artists' permission
@@ -291,6 +733,14 @@ def create_app(test_config=None):
             "message": "bad request"
         }), 400
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+        }), 429
+
     @app.errorhandler(500)
     def internal_error(error):
         return jsonify({
@@ -309,7 +759,24 @@ def create_app(test_config=None):
 
     return app
 
-APP = create_app()
+'''
+APP
+The process-wide app, created on first access (`gunicorn app:APP`,
+manage.py) rather than when the module is imported, so importing app.py
+never touches the database
+'''
+_app = None
+
+def get_app():
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+def __getattr__(name):
+    if name == 'APP':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
-    APP.run(host='127.0.0.1', port=5000, debug=True)
+    get_app().run(host='127.0.0.1', port=5000, debug=True)
@@ -0,0 +1,178 @@
+import asyncio
+import io
+import sys
+from flask import g, request
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.util import await_only, greenlet_spawn
+
+from app import get_app
+from auth import MOCK_TOKENS, parse_auth_header, token_cache, verify_decode_jwt
+from dbpool import PoolMetrics, engine_options
+from models import db
+from slowqueries import setup_slow_query_log
+
+# Async driver used for each database backend
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+# WSGI environ key carrying the engine a request must use
+ENVIRON_BIND = 'music_label.db_bind'
+
+'''
+ASGI entry point
+AsyncAPI serves a Flask app created by create_app() from an asyncio
+event loop, so every route, error response and hook is the same as the
+WSGI app:
+
+- each request runs in its own greenlet, and the database session is
+  bound to an async engine (aiosqlite / asyncpg); while a query waits on
+  the database the event loop serves other requests
+- bearer tokens are verified on a worker thread before the view runs, so
+  a JWKS fetch never blocks the loop; the view finds the payload in the
+  token cache
+- response bodies, including ?stream=1 exports, are sent as the view
+  produces them
+
+    uvicorn asgi:API --workers 4
+'''
+
+def async_url(url):
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def wsgi_environ(scope, body):
+    """Builds the WSGI environ for an ASGI http scope
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin1'), value.decode('latin1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            continue
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def authenticate(environ):
+    """Verifies the request's bearer token off the event loop
+
+    Only warms the token cache: failures are left to requires_auth, which
+    reports them with the usual error responses.
+    """
+    try:
+        token = parse_auth_header(environ.get('HTTP_AUTHORIZATION'))
+    except Exception:
+        return
+    if token in MOCK_TOKENS or token_cache.get(token) is not None:
+        return
+    try:
+        await asyncio.to_thread(verify_decode_jwt, token)
+    except Exception:
+        pass
+
+
+class AsyncAPI:
+    """ASGI application for a Flask app, with async database I/O
+    """
+
+    def __init__(self, app):
+        self.app = app
+        with app.app_context():
+            url = async_url(db.engine.url)
+        options = engine_options(url.render_as_string(hide_password=False), app.config)
+        # async engines bring their own asyncio-aware pool
+        options.pop('poolclass', None)
+        self.engine = create_async_engine(url, **options)
+        app.extensions['pool_metrics'] = PoolMetrics(self.engine.sync_engine)
+        setup_slow_query_log(app, self.engine.sync_engine)
+
+        @app.before_request
+        def bind_async_engine():
+            g.db_bind = request.environ.get(ENVIRON_BIND)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise RuntimeError(f"unsupported ASGI scope type {scope['type']!r}")
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        environ = wsgi_environ(scope, body)
+        environ[ENVIRON_BIND] = self.engine.sync_engine
+        await authenticate(environ)
+        await greenlet_spawn(self.serve, environ, send)
+
+    def serve(self, environ, send):
+        """Runs the Flask app inside a greenlet and sends its response
+        """
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                                  for name, value in headers]
+
+        body = self.app(environ, start_response)
+        try:
+            await_only(send({'type': 'http.response.start', **started}))
+            for chunk in body:
+                if chunk:
+                    await_only(send({'type': 'http.response.body', 'body': chunk, 'more_body': True}))
+            await_only(send({'type': 'http.response.body', 'body': b''}))
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            # the session is scoped to this greenlet; hand its connection back
+            db.session.remove()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+_api = None
+
+def __getattr__(name):
+    # `uvicorn asgi:API` builds the app on first access, like app.APP
+    global _api
+    if name == 'API':
+        if _api is None:
+            _api = AsyncAPI(get_app())
+        return _api
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
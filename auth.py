@@ -1,15 +1,32 @@
 import json
+import hashlib
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 from werkzeug.exceptions import HTTPException
 import os
+import threading
+import time
+
+from profiling import phase
+from ratelimit import check_rate_limit
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
 
+# JWKS cache settings (seconds)
+JWKS_URL = os.environ.get('JWKS_URL')
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_FAILURE_BACKOFF = float(os.environ.get('JWKS_FAILURE_BACKOFF', 30))
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# Verified token cache settings
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_MAX_TTL = float(os.environ.get('TOKEN_CACHE_MAX_TTL', 300))
+
 # Mock tokens for development/testing
 MOCK_TOKENS = {
     'assistant': {
@@ -34,12 +51,185 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS Cache
+'''
+JWKSCache
+Keeps the Auth0 signing keys in memory so requests don't fetch
+/.well-known/jwks.json every time.
+
+- keys are refetched once they are older than `ttl`
+- only one thread refetches; the others keep using the stale keys
+- an unknown `kid` forces a refetch (at most once per `min_refresh_interval`)
+- after a failed fetch no new attempt is made for `backoff` seconds
+'''
+class JWKSCache:
+    def __init__(self, url=None, ttl=JWKS_CACHE_TTL, backoff=JWKS_FAILURE_BACKOFF,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT, clock=time.monotonic):
+        self.url = url
+        self.ttl = ttl
+        self.backoff = backoff
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.clock = clock
+        self.fetch_count = 0
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._keys = None
+        self._fetched_at = None
+        self._failed_at = None
+
+    def jwks_url(self):
+        return self.url or JWKS_URL or f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+    def get_key(self, kid):
+        """Returns the RSA key for `kid`, or None if the JWKS doesn't have it
+        """
+        keys = self._current_keys()
+        if kid not in keys and self._may_force_refresh():
+            keys = self._refresh(force=True)
+        return keys.get(kid)
+
+    def _current_keys(self):
+        if self._keys is None or self._is_stale():
+            return self._refresh()
+        return self._keys
+
+    def _is_stale(self):
+        return self.clock() - self._fetched_at >= self.ttl
+
+    def _may_force_refresh(self):
+        return (self._fetched_at is None or
+                self.clock() - self._fetched_at >= self.min_refresh_interval)
+
+    def _in_backoff(self):
+        return (self._failed_at is not None and
+                self.clock() - self._failed_at < self.backoff)
+
+    def _refresh(self, force=False):
+        # Someone else is already refetching: serve what we have
+        if self._keys is not None:
+            if not self._lock.acquire(blocking=False):
+                return self._keys
+        else:
+            self._lock.acquire()
+
+        try:
+            # Another thread may have refreshed while we waited for the lock
+            if self._keys is not None and not force and not self._is_stale():
+                return self._keys
+            if force and not self._may_force_refresh():
+                return self._keys
+            if self._in_backoff():
+                return self._stale_or_raise()
+
+            try:
+                self._keys = self._fetch()
+                self._fetched_at = self.clock()
+                self._failed_at = None
+            except Exception:
+                self._failed_at = self.clock()
+                return self._stale_or_raise()
+            return self._keys
+        finally:
+            self._lock.release()
+
+    def _stale_or_raise(self):
+        if self._keys is not None:
+            return self._keys
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch signing keys.'
+        }, 503)
+
+    def _fetch(self):
+        self.fetch_count += 1
+        with phase('jwks'):
+            jsonurl = urlopen(self.jwks_url(), timeout=self.timeout)
+            jwks = json.loads(jsonurl.read())
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+jwks_cache = JWKSCache()
+
+
+## Verified Token Cache
+'''
+TokenCache
+Bounded LRU of decoded JWT payloads keyed by a SHA-256 of the raw token,
+so a token that was already verified skips the RS256 check.
+Entries expire at the token's `exp` claim or after `max_ttl`, whichever
+comes first.
+'''
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_MAX_TTL, clock=time.time):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, token, payload):
+        expires_at = self.clock() + self.max_ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+        if self.maxsize <= 0 or expires_at <= self.clock():
+            return
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+token_cache = TokenCache()
+
+
 ## Auth Header
 
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+def parse_auth_header(auth):
+    """Returns the bearer token in an Authorization header value
+    """
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -91,33 +281,29 @@ def verify_decode_jwt(token):
     if os.environ.get('FLASK_ENV') == 'development' or token in MOCK_TOKENS:
         if token in MOCK_TOKENS:
             return MOCK_TOKENS[token]
-    
+
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     # Production Auth0 JWT verification
+    # python-jose is only needed here, so it stays out of app startup
+    from jose import jwt
+
     if not AUTH0_DOMAIN:
         raise AuthError({
             'code': 'configuration_error',
             'description': 'AUTH0_DOMAIN not configured.'
         }, 500)
     
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -127,6 +313,7 @@ def verify_decode_jwt(token):
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
+            token_cache.set(token, payload)
 
             return payload
 
@@ -151,16 +338,44 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+'''
+auth_listeners
+    callables invoked as listener(client) once a request is authenticated,
+    where `client` is the caller's client_key()
+'''
+auth_listeners = []
+
+def client_key(token, payload):
+    """Identifies the caller for per-client state (rate limits, reads after writes):
+    the token's `sub`, the mock token name, or a hash of the token
+    """
+    if payload.get('sub'):
+        return payload['sub']
+    if token in MOCK_TOKENS:
+        return token
+    return hashlib.sha256(token.encode()).hexdigest()
+
 def requires_auth(permission=''):
     """Decorator for routes that require authentication
+
+    `permission` may also be a list of permissions that are all required.
     """
+    permissions = permission if isinstance(permission, (list, tuple)) else [permission]
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             try:
-                token = get_token_auth_header()
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                with phase('auth'):
+                    token = get_token_auth_header()
+                    payload = verify_decode_jwt(token)
+                    for required in permissions:
+                        check_permissions(required, payload)
+                    client = client_key(token, payload)
+                    # 429 once the caller's budget for these permissions is spent
+                    check_rate_limit(client, permissions)
+                    for listener in auth_listeners:
+                        listener(client)
                 return f(payload, *args, **kwargs)
             except AuthError as e:
                 raise e
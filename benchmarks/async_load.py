@@ -0,0 +1,157 @@
+'''
+Sync vs async load benchmark
+Starts the WSGI app under gunicorn sync workers and the ASGI app
+(asgi:API) under uvicorn with the same number of workers, against the
+same seeded SQLite database, then drives each with the same concurrent
+GET mix and reports throughput and latency percentiles.
+
+Needs gunicorn, uvicorn and aiosqlite.
+
+    python benchmarks/async_load.py
+    python benchmarks/async_load.py --workers 4 --concurrency 128 --duration 20
+'''
+import argparse
+import asyncio
+import atexit
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='async-load-bench-')
+atexit.register(shutil.rmtree, WORKDIR, True)
+DATABASE_URL = f'sqlite:///{WORKDIR}/bench.db'
+os.environ['DATABASE_URL'] = DATABASE_URL
+
+ARTISTS = 1000
+ALBUMS_PER_ARTIST = 10
+TOKEN = 'executive'
+
+
+def seed():
+    from app import create_app
+    from models import setup_db, Artist, Album
+
+    # a scratch database, so let setup_db create the schema
+    app = create_app({'DB_CREATE_SCHEMA': True})
+    setup_db(app, DATABASE_URL)
+    with app.app_context():
+        Artist.bulk_insert([
+            {'name': f'Artist {n}', 'age': 20 + n % 50, 'genre': 'Rock', 'country': 'UK'}
+            for n in range(ARTISTS)
+        ])
+        Album.bulk_insert([
+            {'title': f'Album {n}', 'release_date': datetime(2000, 1, 1), 'genre': 'Rock',
+             'track_count': 10, 'artist_id': 1 + n // ALBUMS_PER_ARTIST}
+            for n in range(ARTISTS * ALBUMS_PER_ARTIST)
+        ])
+
+
+def request_paths():
+    return [
+        '/artists?limit=20',
+        '/albums?limit=20',
+        f'/albums/{random.randint(1, ARTISTS * ALBUMS_PER_ARTIST)}',
+        f'/artists/{random.randint(1, ARTISTS)}',
+    ]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def start_server(kind, port, workers):
+    if kind == 'sync':
+        command = ['gunicorn', '--workers', str(workers), '--bind', f'127.0.0.1:{port}', 'app:APP']
+    else:
+        command = ['uvicorn', 'asgi:API', '--workers', str(workers), '--port', str(port),
+                   '--log-level', 'warning', '--no-access-log']
+    env = dict(os.environ, RESPONSE_CACHE_ENABLED='0')
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_until_up(port)
+    return process
+
+
+async def fetch(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write((f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'
+                  f'Authorization: Bearer {TOKEN}\r\nConnection: close\r\n\r\n').encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def load(port, concurrency, duration):
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+
+    async def client():
+        nonlocal errors
+        while time.monotonic() < deadline:
+            path = random.choice(request_paths())
+            started = time.perf_counter()
+            try:
+                status = await fetch(port, path)
+            except OSError:
+                status = None
+            if status != 200:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+def run(kind, args):
+    port = free_port()
+    process = start_server(kind, port, args.workers)
+    try:
+        asyncio.run(load(port, args.concurrency, 2))  # warm up
+        latencies, errors = asyncio.run(load(port, args.concurrency, args.duration))
+    finally:
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    print(f'{kind:>6} {len(latencies) / args.duration:>9.1f} {percentile(latencies, 0.5):>9.1f} '
+          f'{percentile(latencies, 0.95):>9.1f} {percentile(latencies, 0.99):>9.1f} {errors:>7}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    seed()
+    print(f'{args.workers} workers, {args.concurrency} concurrent clients, {args.duration:g}s per app')
+    print(f'{"app":>6} {"req/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"errors":>7}')
+    for kind in ('sync', 'async'):
+        run(kind, args)
@@ -0,0 +1,459 @@
+'''
+Load test
+Seeds a synthetic catalog with seeding.seed_catalog (the generator
+behind `manage.py seed`), starts the API under gunicorn
+(gunicorn.conf.py) or uvicorn (asgi:API), drives every route
+with a weighted request mix from concurrent clients, and reports
+p50/p95/p99 latency and throughput per route and the peak RSS of the
+server processes. Results are written as JSON, so two runs (e.g. two
+commits) can be compared:
+
+    python benchmarks/load.py --catalog 100k --output before.json
+    python benchmarks/load.py --catalog 100k --output after.json
+    python benchmarks/load.py --compare before.json after.json --max-regression 10
+
+Catalogs hold 1k, 100k or 1m albums (and a tenth as many artists) and
+are generated from --seed, so the same arguments always seed the same
+rows. Seeding 1m albums takes about a minute; pass --database to keep
+the file and reuse it (it is only seeded when empty). Write routes change the
+catalog, so a reused database drifts slightly between runs.
+
+Clients authenticate with the mock tokens of auth_simple, picking the
+least privileged token that has the route's permissions.
+'''
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from auth_simple import MOCK_TOKENS
+
+CATALOGS = {'1k': 1000, '100k': 100000, '1m': 1000000}
+ALBUMS_PER_ARTIST = 10
+
+
+def token_for(*permissions):
+    """Returns the mock token with the fewest permissions that has all of `permissions`
+    """
+    tokens = [(len(payload['permissions']), token) for token, payload in MOCK_TOKENS.items()
+              if set(permissions) <= set(payload['permissions'])]
+    return min(tokens)[1]
+
+
+def seed(albums, seed_value):
+    """Seeds `albums` albums (and a tenth as many artists) unless the database has artists
+    """
+    # imported here: models reads DATABASE_URL when it is first imported
+    from manage import create_manage_app, init_schema
+    from models import Artist, Album
+    from seeding import seed_catalog
+
+    app = create_manage_app()
+    with app.app_context():
+        init_schema()
+        if Artist.query.first() is not None:
+            return Artist.query.count(), Album.query.count(), 0.0
+
+        artists = max(albums // ALBUMS_PER_ARTIST, 1)
+        seconds = seed_catalog(artists, albums, seed=seed_value)
+        return artists, albums, seconds
+
+
+'''
+Routes
+Each route builds one request from the client's random generator and
+the shared run state: (method, path, token, body). The write routes
+that remove rows only remove rows the run created itself.
+'''
+
+class RunState:
+    def __init__(self, artists, albums):
+        import seeding
+
+        self.artists = artists
+        self.albums = albums
+        # the seeder's vocabulary, so filters and searches match seeded rows
+        self.genres = list(seeding.GENRES)
+        self.countries = list(seeding.COUNTRIES)
+        self.words = seeding.WORDS
+        self.created = {'artists': deque(), 'albums': deque()}
+        self.batches = {'artists': deque(), 'albums': deque()}
+        self.batch_numbers = iter(range(1, 1 << 62))
+
+
+def title(rng, state, words=2):
+    return ' '.join(rng.choice(state.words) for _ in range(words))
+
+
+def artists_query(rng, state):
+    return rng.choice(['limit=20', f'limit=20&genre={quote(rng.choice(state.genres))}',
+                       f'limit=20&country={quote(rng.choice(state.countries))}',
+                       f'limit=20&name_prefix={rng.choice(state.words)}',
+                       'limit=50&fields=id,name', 'limit=20&include=albums', 'limit=100&format=compact'])
+
+
+def albums_query(rng, state):
+    return rng.choice(['limit=20', f'limit=20&genre={quote(rng.choice(state.genres))}',
+                       f'limit=20&artist_id={rng.randint(1, min(state.artists, 100))}', 'limit=50&fields=id,title',
+                       'limit=20&include=artist', 'limit=100&format=compact'])
+
+
+def artist_body(rng, state, **extra):
+    return dict({'name': title(rng, state), 'age': rng.randint(18, 80), 'genre': rng.choice(state.genres),
+                 'country': rng.choice(state.countries)}, **extra)
+
+
+def album_body(rng, state, **extra):
+    return dict({'title': title(rng, state, 3), 'release_date': f'{rng.randint(1960, 2024)}-06-01',
+                 'genre': rng.choice(state.genres), 'track_count': rng.randint(6, 20),
+                 'artist_id': rng.randint(1, state.artists)}, **extra)
+
+
+def artist_batch(rng, state, size=10):
+    # the batch's country tags its rows for bulk_delete_artists
+    tag = f'B{next(state.batch_numbers)}'
+    return {'artists': [artist_body(rng, state, country=tag) for _ in range(size)]}
+
+
+def album_batch(rng, state, size=10):
+    # the batch's genre tags its rows for bulk_delete_albums
+    tag = f'B{next(state.batch_numbers)}'
+    return {'albums': [album_body(rng, state, genre=tag) for _ in range(size)]}
+
+
+def some_ids(rng, count, size=20):
+    return rng.sample(range(1, count + 1), min(size, count))
+
+
+ROUTES = {
+    'health': lambda rng, state: ('GET', '/health', None, None),
+    'list_artists': lambda rng, state: ('GET', f'/artists?{artists_query(rng, state)}', token_for('get:artists'), None),
+    'list_albums': lambda rng, state: ('GET', f'/albums?{albums_query(rng, state)}', token_for('get:albums'), None),
+    'get_artist': lambda rng, state: (
+        'GET', f'/artists/{rng.randint(1, state.artists)}', token_for('get:artists'), None),
+    'get_album': lambda rng, state: (
+        'GET', f'/albums/{rng.randint(1, state.albums)}', token_for('get:albums'), None),
+    'search': lambda rng, state: (
+        'GET', f'/search?q={rng.choice(state.words)[:rng.randint(2, 5)]}',
+        token_for('get:artists', 'get:albums'), None),
+    'stats': lambda rng, state: ('GET', '/stats', token_for('get:artists', 'get:albums'), None),
+    'create_artist': lambda rng, state: ('POST', '/artists', token_for('post:artists'), artist_body(rng, state)),
+    'create_album': lambda rng, state: ('POST', '/albums', token_for('post:albums'), album_body(rng, state)),
+    'patch_artist': lambda rng, state: (
+        'PATCH', f'/artists/{rng.randint(1, state.artists)}', token_for('patch:artists'),
+        {'age': rng.randint(18, 80)}),
+    'patch_album': lambda rng, state: (
+        'PATCH', f'/albums/{rng.randint(1, state.albums)}', token_for('patch:albums'),
+        {'track_count': rng.randint(6, 20)}),
+    'delete_artist': lambda rng, state: (
+        'DELETE', f'/artists/{state.created["artists"].popleft()}', token_for('delete:artists'), None),
+    'delete_album': lambda rng, state: (
+        'DELETE', f'/albums/{state.created["albums"].popleft()}', token_for('delete:albums'), None),
+    'bulk_create_artists': lambda rng, state: (
+        'POST', '/artists/bulk', token_for('post:artists'), artist_batch(rng, state)),
+    'bulk_create_albums': lambda rng, state: (
+        'POST', '/albums/bulk', token_for('post:albums'), album_batch(rng, state)),
+    'bulk_patch_artists': lambda rng, state: (
+        'PATCH', '/artists/bulk', token_for('patch:artists'),
+        {'ids': some_ids(rng, state.artists), 'changes': {'age': rng.randint(18, 80)}}),
+    'bulk_patch_albums': lambda rng, state: (
+        'PATCH', '/albums/bulk', token_for('patch:albums'),
+        {'ids': some_ids(rng, state.albums), 'changes': {'track_count': rng.randint(6, 20)}}),
+    'bulk_delete_artists': lambda rng, state: (
+        'DELETE', '/artists/bulk', token_for('delete:artists'),
+        {'filter': {'country': state.batches['artists'].popleft()}}),
+    'bulk_delete_albums': lambda rng, state: (
+        'DELETE', '/albums/bulk', token_for('delete:albums'),
+        {'filter': {'genre': state.batches['albums'].popleft()}}),
+}
+
+# Route to run instead while there is nothing of the run's own to delete
+DELETE_FALLBACKS = {
+    'delete_artist': ('create_artist', lambda state: state.created['artists']),
+    'delete_album': ('create_album', lambda state: state.created['albums']),
+    'bulk_delete_artists': ('bulk_create_artists', lambda state: state.batches['artists']),
+    'bulk_delete_albums': ('bulk_create_albums', lambda state: state.batches['albums']),
+}
+
+READS = {'list_artists': 20, 'list_albums': 20, 'get_artist': 15, 'get_album': 15,
+         'search': 10, 'stats': 5, 'health': 1}
+MIXES = {
+    'read': READS,
+    'mixed': dict(READS, create_artist=3, create_album=3, patch_artist=2, patch_album=2,
+                  delete_artist=2, delete_album=2, bulk_create_artists=1, bulk_create_albums=1,
+                  bulk_patch_artists=1, bulk_patch_albums=1, bulk_delete_artists=1, bulk_delete_albums=1),
+    'all': {name: 1 for name in ROUTES},
+}
+
+
+def parse_mix(value):
+    """A mix name, or route=weight pairs such as `list_artists=5,create_artist=1`
+    """
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for pair in value.split(','):
+        name, _, weight = pair.partition('=')
+        if name not in ROUTES:
+            raise argparse.ArgumentTypeError(f'unknown route {name!r}; routes: {", ".join(ROUTES)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def remember(route, state, body, response):
+    # ids and batch tags of the run's own rows, for the delete routes
+    if route in ('create_artist', 'create_album'):
+        state.created[route.split('_')[1] + 's'].append(json.loads(response)['created'])
+    elif route == 'bulk_create_artists':
+        state.batches['artists'].append(body['artists'][0]['country'])
+    elif route == 'bulk_create_albums':
+        state.batches['albums'].append(body['albums'][0]['genre'])
+
+
+'''
+Client and server
+'''
+
+async def send(port, method, path, token, body):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    payload = json.dumps(body).encode() if body is not None else b''
+    headers = [f'{method} {path} HTTP/1.1', 'Host: localhost', 'Connection: close',
+               f'Content-Length: {len(payload)}']
+    if token:
+        headers.append(f'Authorization: Bearer {token}')
+    if body is not None:
+        headers.append('Content-Type: application/json')
+    writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), content
+
+
+async def load(port, mix, state, concurrency, duration, seed_value):
+    samples = defaultdict(list)
+    errors = defaultdict(lambda: defaultdict(int))
+    names, weights = list(mix), list(mix.values())
+    deadline = time.monotonic() + duration
+
+    async def client(number):
+        rng = random.Random(f'{seed_value}-{number}')
+        while time.monotonic() < deadline:
+            route = rng.choices(names, weights)[0]
+            if route in DELETE_FALLBACKS:
+                fallback, pending = DELETE_FALLBACKS[route]
+                if not pending(state):
+                    route = fallback
+            method, path, token, body = ROUTES[route](rng, state)
+            started = time.perf_counter()
+            try:
+                status, content = await send(port, method, path, token, body)
+            except (OSError, IndexError, ValueError):
+                status = None
+            elapsed = time.perf_counter() - started
+            if status != 200:
+                errors[route][str(status or 'connection')] += 1
+                continue
+            samples[route].append(elapsed)
+            remember(route, state, body, content)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(number) for number in range(concurrency)])
+    return samples, errors, time.perf_counter() - started
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if asyncio.run(send(port, 'GET', '/health', None, None))[0] == 200:
+                return
+        except (OSError, IndexError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def start_server(args, port, env):
+    if args.server == 'wsgi':
+        command = ['gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+                   '--log-level', 'warning', 'app:APP']
+        env = dict(env, WEB_CONCURRENCY=str(args.workers), GUNICORN_THREADS=str(args.threads))
+    else:
+        command = ['uvicorn', 'asgi:API', '--workers', str(args.workers), '--port', str(port),
+                   '--log-level', 'warning', '--no-access-log']
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def peak_child_rss_mb():
+    # largest resident set of any finished child process (the server master and workers)
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+'''
+Reports
+'''
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else None
+
+
+def summarize(latencies, errors, elapsed):
+    """`errors` counts the failed requests by status code ('connection' if none)
+    """
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors.values()),
+        'error_statuses': dict(errors),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else None,
+    }
+
+
+def commit():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result):
+    print(f'{"route":>20} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for name, stats in list(result['routes'].items()) + [('total', result['total'])]:
+        if not stats['requests']:
+            print(f'{name:>20} {"-":>9} {"-":>8} {"-":>8} {"-":>8} {stats["errors"]:>7}')
+            continue
+        print(f'{name:>20} {stats["throughput"]:>9.1f} {stats["p50_ms"]:>8.1f} {stats["p95_ms"]:>8.1f} '
+              f'{stats["p99_ms"]:>8.1f} {stats["errors"]:>7}')
+    print(f'peak RSS of a server process: {result["peak_rss_mb"]} MB')
+
+
+def compare(base_path, new_path, max_regression):
+    """Prints the change per route; returns 1 if p95 or throughput regressed more than allowed
+    """
+    with open(base_path) as base_file, open(new_path) as new_file:
+        base, new = json.load(base_file), json.load(new_file)
+    print(f'{base.get("commit")} -> {new.get("commit")}')
+    print(f'{"route":>20} {"p95 ms":>17} {"change":>8} {"req/s":>17} {"change":>8}')
+    regressed = []
+    rows = [(name, stats, base['routes'].get(name)) for name, stats in new['routes'].items()]
+    for name, stats, before in rows + [('total', new['total'], base['total'])]:
+        if not before or not before['requests'] or not stats['requests']:
+            continue
+        p95 = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+        rate = (stats['throughput'] - before['throughput']) / before['throughput'] * 100
+        print(f'{name:>20} {before["p95_ms"]:>8.1f} {stats["p95_ms"]:>8.1f} {p95:>+7.1f}% '
+              f'{before["throughput"]:>8.1f} {stats["throughput"]:>8.1f} {rate:>+7.1f}%')
+        if max_regression is not None and (p95 > max_regression or -rate > max_regression):
+            regressed.append(name)
+    print(f'peak RSS: {base.get("peak_rss_mb")} MB -> {new.get("peak_rss_mb")} MB')
+    if regressed:
+        print(f'regressed by more than {max_regression:g}%: {", ".join(regressed)}')
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog', choices=CATALOGS, default='1k', help='albums in the seeded catalog')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', help='SQLite file to seed and reuse (default: a temporary file)')
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--mix', type=parse_mix, default='mixed',
+                        help=f'{", ".join(MIXES)}, or route=weight pairs; routes: {", ".join(ROUTES)}')
+    parser.add_argument('--no-cache', action='store_true', help='turn the response cache off')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two result files')
+    parser.add_argument('--max-regression', type=float,
+                        help='with --compare: exit 1 if a p95 grows or a throughput drops by more than this %%')
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare, args.max_regression)
+
+    workdir = tempfile.mkdtemp(prefix='load-bench-')
+    atexit.register(shutil.rmtree, workdir, True)
+    database = os.path.abspath(args.database or os.path.join(workdir, 'catalog.db'))
+    os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+    env = dict(os.environ, RESPONSE_CACHE_ENABLED='0' if args.no_cache else '1')
+    env.pop('DB_CREATE_SCHEMA', None)
+
+    artists, albums, seed_seconds = seed(CATALOGS[args.catalog], args.seed)
+    print(f'catalog: {artists} artists, {albums} albums'
+          + (f' (seeded in {seed_seconds:.1f}s)' if seed_seconds else ' (reused)'))
+    state = RunState(artists, albums)
+
+    port = free_port()
+    server = start_server(args, port, env)
+    try:
+        wait_until_up(port)
+        asyncio.run(load(port, args.mix, state, args.concurrency, args.warmup, f'{args.seed}-warmup'))
+        samples, errors, elapsed = asyncio.run(
+            load(port, args.mix, state, args.concurrency, args.duration, args.seed))
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {
+        'commit': commit(),
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('compare', 'max_regression')},
+        'catalog': {'artists': artists, 'albums': albums},
+        'elapsed_seconds': round(elapsed, 2),
+        'routes': {name: summarize(samples[name], errors.get(name, {}), elapsed)
+                   for name in ROUTES if name in samples or name in errors},
+        'total': summarize([value for values in samples.values() for value in values],
+                           {status: sum(route.get(status, 0) for route in errors.values())
+                            for status in {status for route in errors.values() for status in route}},
+                           elapsed),
+        'peak_rss_mb': peak_child_rss_mb(),
+    }
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2)
+        print(f'results written to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
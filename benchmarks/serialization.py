@@ -0,0 +1,100 @@
+'''
+Serialization benchmark
+Compares the two ways GET /albums can build its response body:
+
+- orm:   ORM instances + Album.format() + the stdlib JSON encoder
+- tuple: result tuples (TupleRows) + the orjson provider
+
+Bodies are built through app.json.response(), as jsonify() builds them.
+Each size runs against a fresh SQLite database in a temporary directory.
+
+    python benchmarks/serialization.py              # 10k and 100k albums
+    python benchmarks/serialization.py 50000
+'''
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='serialization-bench-')
+atexit.register(shutil.rmtree, WORKDIR, True)
+# models reads DATABASE_URL at import time
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{WORKDIR}/import.db')
+
+from sqlalchemy.orm import joinedload  # noqa: E402
+
+from app import create_app  # noqa: E402
+from fieldsets import album_formatter  # noqa: E402
+from models import setup_db, db, Artist, Album  # noqa: E402
+from serialization import TupleRows, orjson  # noqa: E402
+
+ALBUMS_PER_ARTIST = 10
+REPEATS = 3
+
+
+def seed(count):
+    artists = count // ALBUMS_PER_ARTIST
+    Artist.bulk_insert([
+        {'name': f'Artist {n}', 'age': 20 + n % 50, 'genre': 'Rock', 'country': 'UK'}
+        for n in range(artists)
+    ])
+    first = db.session.query(db.func.min(Artist.id)).scalar()
+    start = datetime(1970, 1, 1)
+    Album.bulk_insert([
+        {'title': f'Album {n}', 'release_date': start + timedelta(days=n % 20000), 'genre': 'Rock',
+         'track_count': 10, 'artist_id': first + n // ALBUMS_PER_ARTIST}
+        for n in range(count)
+    ])
+
+
+def orm_body(app):
+    albums = Album.query.options(joinedload(Album.artist_ref)).order_by(Album.id).all()
+    rows = [album.format() for album in albums]
+    return app.json.response({'success': True, 'albums': rows, 'total_albums': len(rows)}).get_data()
+
+
+def tuple_body(app):
+    rows = TupleRows(album_formatter())
+    albums = rows.query().order_by(Album.id).all()
+    body = dict(rows.encode('albums', albums), success=True, total_albums=len(albums))
+    return app.json.response(body).get_data()
+
+
+def best_of(function):
+    best = None
+    for _ in range(REPEATS):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        body = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def run(count):
+    # a scratch database, so let setup_db create the schema
+    app = create_app({'RESPONSE_CACHE_ENABLED': False, 'DB_CREATE_SCHEMA': True})
+    setup_db(app, f'sqlite:///{WORKDIR}/albums-{count}.db')
+    with app.test_request_context('/albums'):
+        seed(count)
+
+        app.json.use_orjson = False
+        orm_time, orm_size = best_of(lambda: orm_body(app))
+        app.json.use_orjson = orjson is not None
+        tuple_time, tuple_size = best_of(lambda: tuple_body(app))
+
+    print(f'{count:>8} {orm_time * 1000:>10.1f} {tuple_time * 1000:>10.1f} '
+          f'{orm_time / tuple_time:>8.1f}x {orm_size:>12} {tuple_size:>12}')
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    print(f'encoder: {"orjson" if orjson is not None else "stdlib (orjson not installed)"}')
+    print(f'{"albums":>8} {"orm ms":>10} {"tuple ms":>10} {"speedup":>9} {"orm bytes":>12} {"tuple bytes":>12}')
+    for size in sizes:
+        run(size)
@@ -0,0 +1,72 @@
+'''
+Startup benchmark
+Times cold starts in fresh interpreters against a migrated SQLite
+database:
+
+- import:  `import app` (must not build the app or touch the database)
+- create:  `import app; app.APP` (what a gunicorn worker pays)
+
+Prints the median and worst run of each. With --max-import-ms /
+--max-create-ms it exits non-zero when a median is over budget, so CI
+can run it as a check:
+
+    python benchmarks/startup.py --runs 10 --max-import-ms 1500 --max-create-ms 2500
+'''
+import argparse
+import atexit
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='startup-bench-')
+atexit.register(shutil.rmtree, WORKDIR, True)
+
+TIMER = '''
+import time
+started = time.perf_counter()
+{code}
+print((time.perf_counter() - started) * 1000)
+'''
+
+CASES = {
+    'import': 'import app',
+    'create': 'import app; app.APP',
+}
+
+
+def python(code, env):
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True).stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-create-ms', type=float)
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{WORKDIR}/startup.db')
+    env.pop('DB_CREATE_SCHEMA', None)
+    python('import init_db; init_db.init_database()', env)
+
+    budgets = {'import': args.max_import_ms, 'create': args.max_create_ms}
+    failed = False
+    print(f'{"case":>8} {"median ms":>10} {"max ms":>10} {"budget ms":>10}')
+    for case, code in CASES.items():
+        timings = [float(python(TIMER.format(code=code), env)) for _ in range(args.runs)]
+        median = statistics.median(timings)
+        budget = budgets[case]
+        over = budget is not None and median > budget
+        failed = failed or over
+        print(f'{case:>8} {median:>10.1f} {max(timings):>10.1f} '
+              f'{"-" if budget is None else f"{budget:g}":>10}{"  OVER BUDGET" if over else ""}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
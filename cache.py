@@ -0,0 +1,176 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, has_app_context, request
+
+from models import write_listeners, catalog_version
+
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '1') == '1'
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 60))
+
+'''
+ResponseCache
+Interface for response cache backends. Entries are tagged with the
+tables they were built from and dropped by invalidate(table).
+
+A shared backend (e.g. one backed by a Redis-compatible server) only has
+to implement these methods; `generation` must change on every
+invalidation so a response computed before a write is never stored.
+'''
+class ResponseCache:
+    generation = 0
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, tags, generation=None):
+        raise NotImplementedError
+
+    def invalidate(self, *tags):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+'''
+LRUResponseCache
+Default in-process backend: a bounded LRU with a TTL per entry
+'''
+class LRUResponseCache(ResponseCache):
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self.generation = getattr(self, 'generation', 0) + 1
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, tags, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (self.clock() + self.ttl, frozenset(tags), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self.generation += 1
+            stale = [key for key, entry in self._entries.items() if entry[1] & set(tags)]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+
+'''
+setup_cache(app)
+    attaches a response cache to the app; RESPONSE_CACHE_BACKEND in the
+    app config may hold any ResponseCache instance
+'''
+def setup_cache(app):
+    app.config.setdefault('RESPONSE_CACHE_ENABLED', RESPONSE_CACHE_ENABLED)
+    if not app.config['RESPONSE_CACHE_ENABLED']:
+        return None
+    cache = app.config.get('RESPONSE_CACHE_BACKEND') or LRUResponseCache(
+        maxsize=app.config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE),
+        ttl=app.config.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL))
+    app.extensions['response_cache'] = cache
+    return cache
+
+
+def get_cache():
+    return current_app.extensions.get('response_cache')
+
+
+def invalidate_tables(tables):
+    if has_app_context():
+        cache = get_cache()
+        if cache is not None:
+            cache.invalidate(*tables)
+
+write_listeners.append(invalidate_tables)
+
+
+def cache_key():
+    params = sorted(request.args.items(multi=True))
+    return request.path + '?' + '&'.join(f'{key}={value}' for key, value in params)
+
+
+def cached(*tables):
+    """Conditional GET and response caching for a JSON view built from `tables`
+
+    The catalog version of `tables` is read first: a matching If-None-Match
+    gets a 304 without running the view, and cached bodies are keyed by
+    path, query string and version so they can never be stale.
+    Goes below @requires_auth so permissions are still checked on every hit.
+    Streamed responses get an ETag but are never cached.
+    """
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = cache_key() + '#' + catalog_version(*tables)
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+            cache = get_cache()
+            body = cache.get(key) if cache is not None else None
+            if body is not None:
+                response = current_app.response_class(body, mimetype='application/json')
+                response.set_etag(etag)
+                return response
+
+            generation = cache.generation if cache is not None else None
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                if cache is not None and not response.is_streamed:
+                    cache.set(key, response.get_data(), tables, generation)
+            return response
+
+        return wrapper
+    return cached_decorator
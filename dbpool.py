@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+# Connection pool settings, overridable per app through the same config keys
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+
+# Upper bounds (ms) of the checkout wait histogram buckets
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, float('inf'))
+
+'''
+Connection pool
+Every gunicorn worker holds its own pool, so a worker can open up to
+DB_POOL_SIZE + DB_MAX_OVERFLOW connections; keep
+workers * (size + overflow) under the database's connection limit.
+'''
+
+def engine_options(database_path, config=None):
+    """SQLALCHEMY_ENGINE_OPTIONS for `database_path` from DB_POOL_* config/env
+
+    SQLite keeps its default pool (no connection queue), so only
+    pre-ping and recycle apply to it.
+    """
+    config = config or {}
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', DB_POOL_PRE_PING),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', DB_POOL_RECYCLE),
+    }
+    if not database_path.startswith('sqlite'):
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': config.get('DB_POOL_SIZE', DB_POOL_SIZE),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT),
+        })
+    return options
+
+
+'''
+TimedQueuePool
+QueuePool that reports how long each checkout waited for a connection
+(and checkouts that timed out) to the PoolMetrics attached to it
+'''
+class TimedQueuePool(QueuePool):
+    metrics = None
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeout:
+            if self.metrics is not None:
+                self.metrics.observe_timeout()
+            raise
+        if self.metrics is not None:
+            self.metrics.observe_wait(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; keep reporting to the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds, Prometheus style
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def snapshot(self):
+        return {
+            'buckets': {('+Inf' if bound == float('inf') else str(bound)): count
+                        for bound, count in zip(self.buckets, self.counts)},
+            'count': self.count,
+            'sum': round(self.sum, 3)
+        }
+
+
+'''
+PoolMetrics
+Live counters for one engine's connection pool, fed by pool events and
+by TimedQueuePool. Survives engine.dispose().
+'''
+class PoolMetrics:
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.invalidated = 0
+        self.timeouts = 0
+        self.wait_ms = Histogram(WAIT_BUCKETS_MS)
+
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+        if isinstance(engine.pool, TimedQueuePool):
+            engine.pool.metrics = self
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checked_out -= 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidated += 1
+
+    def observe_wait(self, seconds):
+        with self._lock:
+            self.wait_ms.observe(seconds * 1000)
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        pool = self.engine.pool
+        with self._lock:
+            stats = {
+                'pool_class': type(pool).__name__,
+                'checked_out': self.checked_out,
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'invalidated': self.invalidated,
+                'timeouts': self.timeouts,
+                'checkout_wait_ms': self.wait_ms.snapshot()
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+                'timeout': pool.timeout()
+            })
+        return stats
@@ -0,0 +1,103 @@
+from flask import request, abort
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+from models import Artist, Album
+
+'''
+Sparse fieldsets
+`?fields=` picks the columns of each row and `?include=` the related rows
+to embed (`albums` on artists, `artist` on albums). Only the selected
+columns are loaded and relationships that are not included are not
+queried at all. Without either parameter rows match Model.format().
+
+`?format=compact` encodes the list as a `columns` header plus one array
+per row instead of one object per row.
+'''
+
+ARTIST_COLUMNS = ('id', 'name', 'age', 'genre', 'country')
+ALBUM_COLUMNS = ('id', 'title', 'release_date', 'genre', 'track_count', 'artist_id')
+
+# Columns of the embedded rows, matching format_basic()
+ARTIST_BASIC_COLUMNS = ('id', 'name', 'genre', 'country')
+ALBUM_BASIC_COLUMNS = ('id', 'title', 'release_date', 'genre')
+
+
+def _list_arg(name, allowed):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    items = [item for item in value.split(',') if item]
+    if not set(items) <= set(allowed):
+        abort(400)
+    return items
+
+
+def wants_compact():
+    output = request.args.get('format')
+    if output not in (None, 'json', 'compact'):
+        abort(400)
+    return output == 'compact'
+
+
+def _value(obj, column):
+    value = getattr(obj, column)
+    if column == 'release_date' and value is not None:
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+class RowFormatter:
+    """Turns model instances into row dicts and builds the matching loader options
+
+    `include` is the name of the embedded relationship in the output
+    ('albums' or 'artist'), or None to leave it out.
+    """
+
+    def __init__(self, model, relationship, basic_columns, fields, include):
+        self.model = model
+        self.relationship = relationship
+        self.basic_columns = basic_columns
+        self.fields = fields
+        self.include = include
+        self.columns = list(fields) + ([include] if include else [])
+
+    def options(self):
+        options = [load_only(*[getattr(self.model, column) for column in self.fields]
+                             # the foreign key is needed to load the artist
+                             + ([Album.artist_id] if self.include and self.model is Album else []))]
+        if self.include:
+            related = getattr(self.model, self.relationship)
+            target = related.property.mapper.class_
+            # albums -> artist is many-to-one, so join; artists -> albums is a collection
+            loader = joinedload if self.model is Album else selectinload
+            options.append(loader(related).load_only(
+                *[getattr(target, column) for column in self.basic_columns]))
+        return options
+
+    def __call__(self, obj):
+        row = {column: _value(obj, column) for column in self.fields}
+        if self.include:
+            related = getattr(obj, self.relationship)
+            if isinstance(related, list):
+                row[self.include] = [item.format_basic() for item in related]
+            else:
+                row[self.include] = related.format_basic() if related else None
+        return row
+
+
+def _formatter(model, columns, relationship, include_name, basic_columns):
+    fields = _list_arg('fields', columns)
+    include = _list_arg('include', [include_name])
+    if fields is None and include is None:
+        include = [include_name]
+    return RowFormatter(model, relationship, basic_columns, fields or list(columns),
+                        include_name if include else None)
+
+
+def artist_formatter():
+    return _formatter(Artist, ARTIST_COLUMNS, 'albums', 'albums', ALBUM_BASIC_COLUMNS)
+
+
+def album_formatter():
+    return _formatter(Album, ALBUM_COLUMNS, 'artist_ref', 'artist', ARTIST_BASIC_COLUMNS)
+
@@ -0,0 +1,85 @@
+from datetime import datetime
+from flask import request, abort
+
+from models import Artist, Album
+
+'''
+List filters
+Query string filters for GET /artists and GET /albums, turned into SQL
+criteria so only matching rows leave the database. Each filter has a
+supporting index on the model.
+'''
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def artist_filters():
+    """Criteria from ?genre=&country=&min_age=&max_age=&name_prefix=
+    """
+    criteria = []
+    if 'genre' in request.args:
+        criteria.append(Artist.genre == request.args['genre'])
+    if 'country' in request.args:
+        criteria.append(Artist.country == request.args['country'])
+
+    min_age = _int_arg('min_age')
+    if min_age is not None:
+        criteria.append(Artist.age >= min_age)
+    max_age = _int_arg('max_age')
+    if max_age is not None:
+        criteria.append(Artist.age <= max_age)
+
+    if request.args.get('name_prefix'):
+        prefix = _escape_like(request.args['name_prefix'])
+        criteria.append(Artist.name.like(prefix + '%', escape='\\'))
+    return criteria
+
+
+def album_filters():
+    """Criteria from ?genre=&artist_id=&released_after=&released_before=&min_tracks=&max_tracks=
+
+    Release dates are inclusive and given as YYYY-MM-DD.
+    """
+    criteria = []
+    if 'genre' in request.args:
+        criteria.append(Album.genre == request.args['genre'])
+
+    artist_id = _int_arg('artist_id')
+    if artist_id is not None:
+        criteria.append(Album.artist_id == artist_id)
+
+    released_after = _date_arg('released_after')
+    if released_after is not None:
+        criteria.append(Album.release_date >= released_after)
+    released_before = _date_arg('released_before')
+    if released_before is not None:
+        criteria.append(Album.release_date <= released_before)
+
+    min_tracks = _int_arg('min_tracks')
+    if min_tracks is not None:
+        criteria.append(Album.track_count >= min_tracks)
+    max_tracks = _int_arg('max_tracks')
+    if max_tracks is not None:
+        criteria.append(Album.track_count <= max_tracks)
+    return criteria
@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+
+'''
+Gunicorn configuration
+Loaded by `gunicorn --config gunicorn.conf.py app:APP` (see Procfile).
+Every setting can be overridden from the environment.
+
+Each worker thread needs a database connection, and each worker has its
+own pool, so keep GUNICORN_THREADS <= DB_POOL_SIZE and
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) under the database's
+connection limit. The schema is not created here: run init_db.py first
+(the Procfile release phase does).
+'''
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Heroku sets WEB_CONCURRENCY from the dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# Import the app once in the master; workers share its memory copy-on-write
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# Heroku allows 30 seconds between SIGTERM and SIGKILL
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 25))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers now and then, spread out so they don't restart together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+
+def post_fork(server, worker):
+    """Forgets the database connections inherited from the master
+
+    close=False leaves the master's sockets alone; the worker opens its own.
+    """
+    from app import APP
+    from models import db
+
+    with APP.app_context():
+        db.engine.dispose(close=False)
+    for engine in APP.extensions.get('db_replicas', []):
+        engine.dispose(close=False)
@@ -1,28 +1,26 @@
 #!/usr/bin/env python3
 """
 Database initialization script for Heroku deployment
-This script creates all database tables
+Creates or upgrades the database schema (the Procfile release phase runs it)
 """
 
-import os
-from app import APP
-from models import db, setup_db
+from sqlalchemy import inspect
+
+from manage import create_manage_app, init_schema
+from models import db
 
 def init_database():
     """Initialize database tables"""
     print("Initializing database...")
-    
-    # Setup database with app context
-    with APP.app_context():
-        # Create all tables
-        db.create_all()
-        print("✅ Database tables created successfully!")
-        
+
+    app = create_manage_app()
+    with app.app_context():
+        result = init_schema()
+        print(f"✅ Database schema {result}!")
+
         # Verify tables exist
-        from sqlalchemy import inspect
-        inspector = inspect(db.engine)
-        tables = inspector.get_table_names()
-        print(f"📋 Created tables: {tables}")
+        tables = inspect(db.engine).get_table_names()
+        print(f"📋 Tables: {tables}")
 
 if __name__ == '__main__':
     init_database()
@@ -1,13 +1,81 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+import click
+from flask.cli import FlaskGroup
+from flask_migrate import Migrate, stamp, upgrade
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateTable
 
-from app import APP
-from models import db
+from app import create_app
+from models import db, commit_write, create_schema, reconcile_stats
+from search import include_object
+from seeding import SEED_BATCH_SIZE, seed_catalog
 
-migrate = Migrate(APP, db)
-manager = Manager(APP)
+migrate = Migrate(db=db, include_object=include_object)
 
-manager.add_command('db', MigrateCommand)
+
+def create_manage_app():
+    app = create_app()
+    migrate.init_app(app)
+    return app
+
+manager = FlaskGroup(create_app=create_manage_app)
+
+
+# Tables of the initial migration (0001); later migrations add the rest
+BASELINE_TABLES = ('artists', 'catalog_revisions', 'albums')
+
+
+def init_schema():
+    """Brings the database schema up to date
+
+    A new database gets the whole schema at once and is stamped with the
+    latest migration; a database already under migrations is upgraded.
+    A database created before migrations existed (tables but no
+    alembic_version) gets any missing baseline tables, is stamped at the
+    initial migration and upgraded, so it gets the later indexes, search
+    tables and counters too.
+    """
+    tables = inspect(db.engine).get_table_names()
+    if 'alembic_version' in tables:
+        upgrade()
+        return 'upgraded'
+    if 'artists' not in tables:
+        create_schema()
+        stamp()
+        return 'created'
+    with db.engine.begin() as connection:
+        for name in BASELINE_TABLES:
+            if name not in tables:
+                # the bare table, as 0001 creates it; indexes come from the migrations
+                connection.execute(CreateTable(db.metadata.tables[name]))
+    stamp(revision='0001')
+    upgrade()
+    return 'upgraded from the initial schema'
+
+
+@manager.command('init-schema')
+def init_schema_command():
+    """Create or upgrade the database schema"""
+    print(f'Database schema {init_schema()}.')
+
+
+@manager.command('reconcile-stats')
+def reconcile_stats_command():
+    """Recount the GET /stats counters from the artists and albums tables"""
+    reconcile_stats()
+    commit_write('catalog_stats')
+    print('Catalog statistics reconciled.')
+
+@manager.command('seed')
+@click.option('--artists', default=10000, show_default=True, help='Artists to add')
+@click.option('--albums', default=100000, show_default=True, help='Albums to add, spread over the new artists')
+@click.option('--seed', 'seed_value', default=0, show_default=True, help='Random seed; the same seed gives the same rows')
+@click.option('--batch-size', default=SEED_BATCH_SIZE, show_default=True, help='Rows per transaction')
+def seed_command(artists, albums, seed_value, batch_size):
+    """Add a synthetic catalog of ARTISTS artists and ALBUMS albums"""
+    seconds = seed_catalog(artists, albums, seed=seed_value, batch_size=batch_size)
+    rows = artists + albums
+    print(f'Seeded {artists} artists and {albums} albums in {seconds:.1f}s '
+          f'({rows / seconds if seconds else 0:,.0f} rows/s).')
 
 if __name__ == '__main__':
-    manager.run()
+    manager()
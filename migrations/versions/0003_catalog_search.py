@@ -0,0 +1,55 @@
+"""catalog full-text search
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+# (table, text column) pairs; keep in sync with search.py
+SEARCHABLE = [('artists', 'name'), ('albums', 'title')]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCHABLE:
+        if dialect == 'sqlite':
+            op.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+                f"{column}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+            op.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN "
+                f"INSERT INTO {table}_fts(rowid, {column}) VALUES (new.id, new.{column}); END")
+            op.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN "
+                f"INSERT INTO {table}_fts({table}_fts, rowid, {column}) VALUES ('delete', old.id, old.{column}); END")
+            op.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE OF {column} ON {table} BEGIN "
+                f"INSERT INTO {table}_fts({table}_fts, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+                f"INSERT INTO {table}_fts(rowid, {column}) VALUES (new.id, new.{column}); END")
+            # Index the rows that already exist
+            op.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+        elif dialect == 'postgresql':
+            op.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_fts ON {table} "
+                f"USING gin (to_tsvector('simple', {column}))")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCHABLE:
+        if dialect == 'sqlite':
+            for suffix in ('ai', 'ad', 'au'):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{suffix}")
+            op.execute(f"DROP TABLE IF EXISTS {table}_fts")
+        elif dialect == 'postgresql':
+            op.execute(f"DROP INDEX IF EXISTS ix_{table}_{column}_fts")
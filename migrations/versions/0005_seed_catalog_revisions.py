@@ -0,0 +1,30 @@
+"""seed catalog revisions
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 14:05:37.512904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+# Same as models.ensure_revisions()
+TABLES = ('artists', 'albums', 'catalog_stats')
+
+
+def upgrade():
+    for table in TABLES:
+        op.execute(f"INSERT INTO catalog_revisions (table_name, revision) SELECT '{table}', 0 "
+                   f"WHERE NOT EXISTS (SELECT 1 FROM catalog_revisions WHERE table_name = '{table}')")
+
+
+def downgrade():
+    # The rows are harmless (and in use) after a downgrade; leave them
+    pass
@@ -1,26 +1,171 @@
 import os
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Index, create_engine, select, func, inspect
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql, sqlite
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from datetime import datetime
 import json
 
+from dbpool import PoolMetrics, engine_options
+from profiling import phase
+from slowqueries import setup_slow_query_log
+
 database_path = os.environ.get('DATABASE_URL', 'sqlite:///music_label.db')
+# Create missing tables when an app is set up (local scratch databases and
+# tests); deployments manage the schema with init_db.py / migrations
+DB_CREATE_SCHEMA = os.environ.get('DB_CREATE_SCHEMA', '0') == '1'
+# Rows per INSERT statement for bulk loads
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
 if database_path and database_path.startswith("postgres://"):
     database_path = database_path.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
+'''
+RoutingSession
+Session that sends reads to the replica engine chosen for the current
+request (`g.db_replica`, set by replicas.py) and everything else,
+including flushes, to the primary. `g.db_bind` (set by asgi.py) replaces
+both for the whole request.
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if has_app_context():
+            if g.get('db_bind') is not None:
+                return g.db_bind
+            if g.get('db_replica') is not None and not self._flushing:
+                return g.db_replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service; pool settings
+    come from the DB_POOL_* app config or environment variables, and
+    statements slower than SLOW_QUERY_MS go to the slow query log. Only
+    creates the schema when DB_CREATE_SCHEMA is on; otherwise it is left
+    to init_db.py and the migrations
 '''
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path, app.config)
     db.app = app
     db.init_app(app)
     with app.app_context():
-        db.create_all()
+        metrics = app.extensions.get('pool_metrics')
+        if metrics is None or metrics.engine is not db.engine:
+            app.extensions['pool_metrics'] = PoolMetrics(db.engine)
+        setup_slow_query_log(app, db.engine)
+        if app.config.get('DB_CREATE_SCHEMA', DB_CREATE_SCHEMA):
+            create_schema()
+
+'''
+create_schema()
+    creates missing tables and seeds the revision and stats rows;
+    safe to run on an existing database
+'''
+def create_schema():
+    db.create_all()
+    ensure_revisions()
+    ensure_stats()
+
+'''
+write_listeners
+    callables invoked as listener(tables) after every committed write,
+    where `tables` is a tuple of the table names that changed
+'''
+write_listeners = []
+
+def notify_write(*tables):
+    for listener in write_listeners:
+        listener(tables)
+
+'''
+commit_write(*tables, stats=None)
+    commits the session, bumping the catalog revision of `tables` and
+    applying the `stats` counter deltas in the same transaction, then
+    notifies the write listeners
+'''
+def commit_write(*tables, stats=None):
+    try:
+        bump_revisions(*tables)
+        if stats:
+            apply_stats(stats)
+        # COMMIT itself is not a cursor execution; count it as database time
+        with phase('db'):
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    notify_write(*tables)
+
+'''
+bulk_insert(model, rows)
+    inserts a list of column dicts with one executemany INSERT per
+    chunk, all inside a single transaction
+'''
+def bulk_insert(model, rows, chunk_size=BULK_CHUNK_SIZE):
+    try:
+        for start in range(0, len(rows), chunk_size):
+            db.session.execute(model.__table__.insert(), rows[start:start + chunk_size])
+    except Exception:
+        db.session.rollback()
+        raise
+    commit_write(model.__tablename__, stats=merge_stats(*(model.row_stats(row) for row in rows)))
+
+'''
+matched_stats(model, criteria, sign=1, values=None)
+    counter deltas of the rows matching `criteria`, with `values`
+    applied; one GROUP BY over the model's stat columns, read before a
+    set-based write changes the rows
+'''
+def matched_stats(model, criteria, sign=1, values=None):
+    columns = [getattr(model, name) for name in model.stat_columns]
+    deltas = []
+    for *group, count in db.session.query(*columns, func.count()).filter(*criteria).group_by(*columns):
+        row = dict(zip(model.stat_columns, group), **(values or {}))
+        deltas.append({key: delta * count for key, delta in model.row_stats(row, sign).items()})
+    return merge_stats(*deltas)
+
+'''
+bulk_update(model, criteria, values) / bulk_delete(model, criteria)
+    set-based UPDATE/DELETE of every row matching `criteria` in one
+    transaction, without loading the rows; return the affected row count
+'''
+def bulk_update(model, criteria, values):
+    try:
+        stats = None
+        if set(values) & set(model.stat_columns):
+            stats = merge_stats(matched_stats(model, criteria, -1), matched_stats(model, criteria, 1, values))
+        count = model.query.filter(*criteria).update(values, synchronize_session=False)
+    except Exception:
+        db.session.rollback()
+        raise
+    commit_write(model.__tablename__, 'catalog_stats', stats=stats)
+    return count
+
+def bulk_delete(model, criteria, children=()):
+    try:
+        # `children` are (model, fk column) pairs deleted first, like a cascade
+        parent_ids = select(model.id).where(*criteria)
+        stats = merge_stats(matched_stats(model, criteria, -1),
+                            *(matched_stats(child, [fk.in_(parent_ids)], -1) for child, fk in children))
+        for child, fk in children:
+            child.query.filter(fk.in_(parent_ids)).delete(synchronize_session=False)
+        count = model.query.filter(*criteria).delete(synchronize_session=False)
+    except Exception:
+        db.session.rollback()
+        raise
+    commit_write(model.__tablename__, 'catalog_stats', *(child.__tablename__ for child, _ in children),
+                 stats=stats)
+    return count
 
 '''
 Artist
@@ -28,6 +173,14 @@ Music artist with attributes name, age, genre, and country
 '''
 class Artist(db.Model):
     __tablename__ = 'artists'
+    # columns the catalog counters depend on
+    stat_columns = ('genre', 'country')
+    __table_args__ = (
+        Index('ix_artists_genre_country', 'genre', 'country'),
+        Index('ix_artists_country', 'country'),
+        # pattern ops so Postgres can use the index for `name LIKE 'prefix%'`
+        Index('ix_artists_name', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(120), nullable=False)
@@ -35,8 +188,9 @@ class Artist(db.Model):
     genre = Column(String(50), nullable=False)
     country = Column(String(50), nullable=False)
     
-    # One-to-many relationship with albums
-    albums = db.relationship('Album', backref='artist_ref', lazy=True, cascade='all, delete-orphan')
+    # One-to-many relationship with albums, in id order like the tuple rows
+    albums = db.relationship('Album', backref='artist_ref', lazy=True, cascade='all, delete-orphan',
+                             order_by='Album.id')
 
     def __init__(self, name, age, genre, country):
         self.name = name
@@ -44,16 +198,48 @@ class Artist(db.Model):
         self.genre = genre
         self.country = country
 
+    @classmethod
+    def bulk_insert(cls, rows):
+        bulk_insert(cls, rows)
+
+    @classmethod
+    def bulk_update(cls, criteria, values):
+        return bulk_update(cls, criteria, values)
+
+    @classmethod
+    def bulk_delete(cls, criteria):
+        # Matches the albums 'all, delete-orphan' cascade with one DELETE
+        return bulk_delete(cls, criteria, children=[(Album, Album.artist_id)])
+
+    @staticmethod
+    def stat_deltas(genre, country, sign=1):
+        return {
+            ('totals', 'artists'): sign,
+            ('artists_by_genre', genre): sign,
+            ('artists_by_country', country): sign
+        }
+
+    @classmethod
+    def row_stats(cls, row, sign=1):
+        return cls.stat_deltas(row['genre'], row['country'], sign)
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write('artists', 'catalog_stats', stats=Artist.stat_deltas(self.genre, self.country))
 
     def update(self):
-        db.session.commit()
+        stats = merge_stats(
+            Artist.stat_deltas(previous_value(self, 'genre'), previous_value(self, 'country'), -1),
+            Artist.stat_deltas(self.genre, self.country))
+        commit_write('artists', 'catalog_stats', stats=stats)
 
     def delete(self):
+        # The albums go with the artist (delete-orphan cascade)
+        stats = merge_stats(
+            Artist.stat_deltas(self.genre, self.country, -1),
+            *(Album.stat_deltas(album.genre, album.track_count, -1) for album in self.albums))
         db.session.delete(self)
-        db.session.commit()
+        commit_write('artists', 'albums', 'catalog_stats', stats=stats)
 
     def format(self):
         return {
@@ -79,6 +265,14 @@ Music album with attributes title, release_date, and artist_id (foreign key)
 '''
 class Album(db.Model):
     __tablename__ = 'albums'
+    # columns the catalog counters depend on
+    stat_columns = ('genre', 'track_count')
+    __table_args__ = (
+        # also serves the artist -> albums relationship loads
+        Index('ix_albums_artist_id_release_date', 'artist_id', 'release_date'),
+        Index('ix_albums_genre_release_date', 'genre', 'release_date'),
+        Index('ix_albums_release_date', 'release_date'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String(120), nullable=False)
@@ -96,16 +290,44 @@ class Album(db.Model):
         self.track_count = track_count
         self.artist_id = artist_id
 
+    @classmethod
+    def bulk_insert(cls, rows):
+        bulk_insert(cls, rows)
+
+    @classmethod
+    def bulk_update(cls, criteria, values):
+        return bulk_update(cls, criteria, values)
+
+    @classmethod
+    def bulk_delete(cls, criteria):
+        return bulk_delete(cls, criteria)
+
+    @staticmethod
+    def stat_deltas(genre, track_count, sign=1):
+        return {
+            ('totals', 'albums'): sign,
+            ('totals', 'tracks'): sign * (track_count or 0),
+            ('albums_by_genre', genre): sign
+        }
+
+    @classmethod
+    def row_stats(cls, row, sign=1):
+        return cls.stat_deltas(row['genre'], row['track_count'], sign)
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write('albums', 'catalog_stats', stats=Album.stat_deltas(self.genre, self.track_count))
 
     def update(self):
-        db.session.commit()
+        stats = merge_stats(
+            Album.stat_deltas(previous_value(self, 'genre'), previous_value(self, 'track_count'), -1),
+            Album.stat_deltas(self.genre, self.track_count))
+        commit_write('albums', 'catalog_stats', stats=stats)
 
     def delete(self):
+        stats = Album.stat_deltas(self.genre, self.track_count, -1)
         db.session.delete(self)
-        db.session.commit()
+        commit_write('albums', 'catalog_stats', stats=stats)
 
     def format(self):
         return {
@@ -125,3 +347,118 @@ class Album(db.Model):
             'release_date': self.release_date.strftime('%Y-%m-%d'),
             'genre': self.genre
         }
+
+UPSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+'''
+increment(model, keys, column, delta)
+    adds `delta` to `column` of the row with primary key `keys`, creating
+    the row (with `delta`) when it is missing, in one INSERT ... ON
+    CONFLICT DO UPDATE, so concurrent writers cannot both insert it
+'''
+def increment(model, keys, column, delta):
+    upsert = UPSERTS.get(db.session.get_bind().dialect.name)
+    if upsert is None:
+        # no upsert on this backend: update, then insert when nothing matched
+        criteria = [getattr(model, name) == value for name, value in keys.items()]
+        if not model.query.filter(*criteria).update(
+                {getattr(model, column): getattr(model, column) + delta}, synchronize_session=False):
+            db.session.add(model(**keys, **{column: delta}))
+        return
+    statement = upsert(model.__table__).values(**keys, **{column: delta})
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={column: model.__table__.c[column] + statement.excluded[column]}))
+
+'''
+CatalogRevision
+Per-table revision counter, bumped in the same transaction as every write
+made through the models. Cheap to read, so it serves as the version for
+ETags and response cache keys.
+'''
+class CatalogRevision(db.Model):
+    __tablename__ = 'catalog_revisions'
+
+    table_name = Column(String(50), primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+
+def ensure_revisions():
+    existing = {name for (name,) in db.session.query(CatalogRevision.table_name)}
+    for table in (Artist.__tablename__, Album.__tablename__, CatalogStat.__tablename__):
+        if table not in existing:
+            db.session.add(CatalogRevision(table_name=table, revision=0))
+    db.session.commit()
+
+def bump_revisions(*tables):
+    for table in sorted(set(tables)):
+        increment(CatalogRevision, {'table_name': table}, 'revision', 1)
+
+def catalog_version(*tables):
+    """Returns a string that changes whenever any of `tables` is written
+    """
+    revisions = dict(db.session.query(CatalogRevision.table_name, CatalogRevision.revision)
+                     .filter(CatalogRevision.table_name.in_(tables)))
+    return ','.join(f'{table}:{revisions.get(table, 0)}' for table in sorted(tables))
+
+'''
+CatalogStat
+Aggregate counters behind GET /stats, one row per (metric, key):
+totals (artists, albums, tracks), artists_by_genre, artists_by_country
+and albums_by_genre. Model writes apply deltas in their own transaction;
+reconcile_stats() recounts everything from the catalog tables.
+'''
+class CatalogStat(db.Model):
+    __tablename__ = 'catalog_stats'
+
+    metric = Column(String(50), primary_key=True)
+    key = Column(String(50), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+def merge_stats(*deltas):
+    merged = {}
+    for delta in deltas:
+        for key, value in delta.items():
+            merged[key] = merged.get(key, 0) + value
+    return {key: value for key, value in merged.items() if value}
+
+def previous_value(obj, attr):
+    """Value of `attr` before the pending (uncommitted) change, if any
+    """
+    history = inspect(obj).attrs[attr].history
+    return history.deleted[0] if history.deleted else getattr(obj, attr)
+
+def apply_stats(deltas):
+    # in key order, so concurrent writers lock the rows in the same order
+    for (metric, key), delta in sorted(deltas.items()):
+        increment(CatalogStat, {'metric': metric, 'key': key}, 'value', delta)
+
+def reconcile_stats():
+    """Recounts every counter from artists/albums; the caller commits
+    """
+    CatalogStat.query.delete(synchronize_session=False)
+    counts = {
+        ('totals', 'artists'): db.session.query(func.count(Artist.id)).scalar(),
+        ('totals', 'albums'): db.session.query(func.count(Album.id)).scalar(),
+        ('totals', 'tracks'): db.session.query(func.coalesce(func.sum(Album.track_count), 0)).scalar()
+    }
+    for metric, column in (('artists_by_genre', Artist.genre),
+                           ('artists_by_country', Artist.country),
+                           ('albums_by_genre', Album.genre)):
+        for key, count in db.session.query(column, func.count()).group_by(column):
+            counts[metric, key] = count
+    db.session.add_all(CatalogStat(metric=metric, key=key, value=value)
+                       for (metric, key), value in counts.items())
+
+def ensure_stats():
+    # First start on a database that predates catalog_stats
+    if CatalogStat.query.first() is None:
+        reconcile_stats()
+        db.session.commit()
+
+def get_stats():
+    stats = {'totals': {'artists': 0, 'albums': 0, 'tracks': 0},
+             'artists_by_genre': {}, 'artists_by_country': {}, 'albums_by_genre': {}}
+    for metric, key, value in db.session.query(CatalogStat.metric, CatalogStat.key, CatalogStat.value):
+        if value:
+            stats.setdefault(metric, {})[key] = value
+    return stats
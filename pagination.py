@@ -0,0 +1,67 @@
+import base64
+import binascii
+import json
+import os
+from flask import request, abort
+
+# Hard server-side limit on page size, whatever the client asks for
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+
+'''
+Keyset pagination helpers
+Pages are selected with `WHERE id > :after ORDER BY id LIMIT :limit`
+so deep pages cost the same as the first one (no OFFSET scan).
+The position is handed to clients as an opaque cursor token.
+'''
+
+def encode_cursor(last_id):
+    raw = json.dumps({'after': last_id}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(token):
+    """Returns the id encoded in a cursor token, or raises ValueError
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        after = json.loads(base64.urlsafe_b64decode(padded.encode()))['after']
+    except (binascii.Error, UnicodeDecodeError, ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(after, int) or isinstance(after, bool):
+        raise ValueError('invalid cursor')
+    return after
+
+
+def get_page_args():
+    """Reads `limit` and `cursor` from the query string
+
+    Returns (limit, after_id), or (None, None) when the client did not ask
+    for pagination. Aborts with 400 on malformed values.
+    """
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        return None, None
+
+    try:
+        limit = MAX_PAGE_SIZE if limit is None else int(limit)
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+def paginate(query, column, limit, after=None):
+    """Returns (items, next_cursor) for one keyset page of `query`
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    items = query.order_by(column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].id)
+    return items, next_cursor
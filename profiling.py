@@ -0,0 +1,326 @@
+import cProfile
+import itertools
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+from dbpool import Histogram
+
+# Per-route timings and SQL counts; GET /metrics (Prometheus text format) also needs INTERNAL_ENDPOINTS
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '0') == '1'
+# Write a cProfile dump for every Nth request; 0 turns the sampler off
+PROFILE_SAMPLE_EVERY = int(os.environ.get('PROFILE_SAMPLE_EVERY', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+# Upper bounds of the request duration (seconds) and SQL statement count buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, float('inf'))
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+'''
+Request profiling
+With PROFILING_ENABLED, every request's wall time is split into phases:
+
+- auth:       token parsing, verification and permission checks
+- jwks:       fetching the Auth0 signing keys (part of authentication)
+- db:         executing SQL statements
+- serialize:  building the response rows and encoding them to JSON
+- view:       everything else
+
+Phases nest; time is charged to the innermost one, so the phases of a
+request add up to its duration. Statements are counted from engine
+events. Rows read are counted where they are produced, since drivers
+such as sqlite3 report no rowcount for SELECTs: ORM instances as they
+load, result tuples in TupleRows. Rows written come from the driver's
+rowcount of each INSERT, UPDATE and DELETE.
+'''
+
+class RequestProfile:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = self._mark = clock()
+        self.stack = ['view']
+        self.phases = defaultdict(float)
+        self.statements = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.status = 500
+
+    def enter(self, name):
+        self._switch()
+        self.stack.append(name)
+
+    def exit(self):
+        self._switch()
+        self.stack.pop()
+
+    def _switch(self):
+        now = self.clock()
+        self.phases[self.stack[-1]] += now - self._mark
+        self._mark = now
+
+    def finish(self):
+        """Charges the time so far and returns the request's duration
+        """
+        self._switch()
+        return self._mark - self.started
+
+
+def current_profile():
+    return g.get('profile') if has_request_context() else None
+
+
+@contextmanager
+def phase(name):
+    """Charges the time spent in the block to phase `name` of the current request
+    """
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    profile.enter(name)
+    try:
+        yield
+    finally:
+        profile.exit()
+
+
+def count_rows(count):
+    """Adds `count` rows read from the database to the current request
+    """
+    profile = current_profile()
+    if profile is not None:
+        profile.rows_read += count
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    if profile is not None:
+        profile.enter('db')
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    if profile is not None:
+        profile.exit()
+        profile.statements += 1
+        if statement.lstrip()[:6].upper() in WRITES:
+            profile.rows_written += max(cursor.rowcount, 0)
+
+
+def _handle_error(exception_context):
+    profile = current_profile()
+    if profile is not None and profile.stack[-1] == 'db':
+        profile.exit()
+        profile.statements += 1
+
+def _load(target, context):
+    count_rows(1)
+
+_listening = False
+
+def _listen_to_engines():
+    # Every engine (primary, replicas, the ASGI engine) reports to the request profile
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        event.listen(Mapper, 'load', _load)
+        _listening = True
+
+
+def _labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped))
+
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else f'{value:g}'
+
+
+'''
+RequestMetrics
+Aggregated request profiles of one worker, by method and route
+'''
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+
+    def observe(self, method, route, profile, duration):
+        with self._lock:
+            stats = self.routes.get((method, route))
+            if stats is None:
+                stats = self.routes[(method, route)] = {
+                    'status': Counter(),
+                    'duration': Histogram(DURATION_BUCKETS),
+                    'statements': Histogram(STATEMENT_BUCKETS),
+                    'phases': defaultdict(float),
+                    'rows_read': 0,
+                    'rows_written': 0
+                }
+            stats['status'][profile.status] += 1
+            stats['duration'].observe(duration)
+            stats['statements'].observe(profile.statements)
+            stats['rows_read'] += profile.rows_read
+            stats['rows_written'] += profile.rows_written
+            for name, seconds in profile.phases.items():
+                stats['phases'][name] += seconds
+
+    def render(self, pool=None):
+        """Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def histogram(name, labels, histogram):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'{name}_bucket{{{_labels(**labels, le=_bound(bound))}}} {count}')
+            lines.append(f'{name}_sum{{{_labels(**labels)}}} {histogram.sum:g}')
+            lines.append(f'{name}_count{{{_labels(**labels)}}} {histogram.count}')
+
+        with self._lock:
+            routes = sorted(self.routes.items())
+
+            metric('http_requests_total', 'counter', 'Requests served, by route and status code.')
+            for (method, route), stats in routes:
+                for status, count in sorted(stats['status'].items()):
+                    lines.append(f'http_requests_total{{{_labels(method=method, route=route, status=status)}}} {count}')
+
+            metric('http_request_duration_seconds', 'histogram', 'Request wall time.')
+            for (method, route), stats in routes:
+                histogram('http_request_duration_seconds', {'method': method, 'route': route}, stats['duration'])
+
+            metric('http_request_phase_seconds_total', 'counter',
+                   'Request wall time spent in each phase (auth, jwks, db, serialize, view).')
+            for (method, route), stats in routes:
+                for name, seconds in sorted(stats['phases'].items()):
+                    lines.append(f'http_request_phase_seconds_total'
+                                 f'{{{_labels(method=method, route=route, phase=name)}}} {seconds:g}')
+
+            metric('http_request_sql_statements', 'histogram', 'SQL statements executed per request.')
+            for (method, route), stats in routes:
+                histogram('http_request_sql_statements', {'method': method, 'route': route}, stats['statements'])
+
+            metric('http_request_sql_rows_read_total', 'counter',
+                   'Rows read from the database: ORM instances loaded and result tuples encoded.')
+            for (method, route), stats in routes:
+                lines.append(f'http_request_sql_rows_read_total{{{_labels(method=method, route=route)}}} '
+                             f'{stats["rows_read"]}')
+
+            metric('http_request_sql_rows_written_total', 'counter',
+                   'Rows inserted, updated or deleted, as reported by the database driver.')
+            for (method, route), stats in routes:
+                lines.append(f'http_request_sql_rows_written_total{{{_labels(method=method, route=route)}}} '
+                             f'{stats["rows_written"]}')
+
+        if pool is not None:
+            stats = pool.snapshot()
+            for name, kind, key, help in (
+                    ('db_pool_checked_out', 'gauge', 'checked_out', 'Connections currently in use.'),
+                    ('db_pool_checkouts_total', 'counter', 'checkouts', 'Connections handed out by the pool.'),
+                    ('db_pool_connects_total', 'counter', 'connects', 'Database connections opened.'),
+                    ('db_pool_timeouts_total', 'counter', 'timeouts', 'Checkouts that timed out waiting.')):
+                metric(name, kind, help)
+                lines.append(f'{name} {stats[key]}')
+            metric('db_pool_checkout_wait_seconds', 'histogram', 'Time spent waiting for a connection.')
+            wait = stats['checkout_wait_ms']
+            for bound, count in wait['buckets'].items():
+                seconds = bound if bound == '+Inf' else f'{float(bound) / 1000:g}'
+                lines.append(f'db_pool_checkout_wait_seconds_bucket{{le="{seconds}"}} {count}')
+            lines.append(f"db_pool_checkout_wait_seconds_sum {wait['sum'] / 1000:g}")
+            lines.append(f"db_pool_checkout_wait_seconds_count {wait['count']}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _profile_path(directory, number, route):
+    name = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    stamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+    return os.path.join(directory, f'{stamp}-{request.method}-{name}-{number}.prof')
+
+
+'''
+setup_profiling(app)
+    adds the request profiler when PROFILING_ENABLED is on, GET /metrics
+    when INTERNAL_ENDPOINTS is on too, and the cProfile sampler when
+    PROFILE_SAMPLE_EVERY is set; does nothing otherwise
+'''
+def setup_profiling(app):
+    app.config.setdefault('PROFILING_ENABLED', PROFILING_ENABLED)
+    app.config.setdefault('PROFILE_SAMPLE_EVERY', PROFILE_SAMPLE_EVERY)
+    app.config.setdefault('PROFILE_DIR', PROFILE_DIR)
+    enabled = app.config['PROFILING_ENABLED']
+    sample_every = app.config['PROFILE_SAMPLE_EVERY']
+    if not enabled and not sample_every:
+        return None
+
+    metrics = RequestMetrics() if enabled else None
+    if enabled:
+        app.extensions['request_metrics'] = metrics
+    requests = itertools.count(1)
+    # one cProfile at a time: concurrent requests are not sampled
+    sampling = threading.Lock()
+
+    if enabled:
+        _listen_to_engines()
+
+    # unauthenticated, like the /internal/* endpoints
+    if enabled and app.config.get('INTERNAL_ENDPOINTS'):
+        @app.route('/metrics')
+        def metrics_endpoint():
+            return Response(metrics.render(app.extensions.get('pool_metrics')),
+                            mimetype='text/plain; version=0.0.4')
+
+    @app.before_request
+    def start_profile():
+        if request.endpoint == 'metrics_endpoint':
+            return
+        if enabled:
+            g.profile = RequestProfile()
+        number = next(requests)
+        if sample_every and number % sample_every == 0 and sampling.acquire(blocking=False):
+            g.sample = (number, cProfile.Profile())
+            g.sample[1].enable()
+
+    @app.after_request
+    def record_status(response):
+        profile = g.get('profile')
+        if profile is not None:
+            profile.status = response.status_code
+            # phases so far; a streamed body is still to come
+            duration = profile.finish()
+            response.headers['Server-Timing'] = ', '.join(
+                [f'{name};dur={seconds * 1000:.2f}' for name, seconds in sorted(profile.phases.items())] +
+                [f'total;dur={duration * 1000:.2f}'])
+        return response
+
+    @app.teardown_request
+    def finish_profile(error=None):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        sample = g.pop('sample', None)
+        if sample is not None:
+            number, profiler = sample
+            profiler.disable()
+            sampling.release()
+            os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+            profiler.dump_stats(_profile_path(app.config['PROFILE_DIR'], number, route))
+        profile = g.pop('profile', None)
+        if profile is not None:
+            metrics.observe(request.method, route, profile, profile.finish())
+
+    return metrics
@@ -0,0 +1,175 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from flask import abort, current_app, g, has_app_context
+
+# Budgets per permission, e.g. "get:albums=60/m, post:albums=10/m:2, *=20/s"; unset means no limits
+RATE_LIMITS = os.environ.get('RATE_LIMITS', '')
+# Buckets kept by the in-process store (least recently used are dropped)
+RATE_LIMIT_STORE_SIZE = int(os.environ.get('RATE_LIMIT_STORE_SIZE', 10000))
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+BUDGET = re.compile(r'^\s*([\w:*-]+)\s*=\s*(\d+)\s*/\s*(\d*)\s*([smh])\s*(?::\s*(\d+))?\s*$')
+
+'''
+Rate limits
+Each client (the JWT `sub`, or the mock token name) gets a token bucket
+per budgeted permission. A budget "N/period" refills N tokens per period
+into a bucket holding N, or the burst given after the colon:
+
+    RATE_LIMITS="get:albums=60/m, post:albums=10/m:2, *=20/s"
+
+`*` applies to every authenticated request. requires_auth takes one
+token from each bucket of the route's permissions and answers 429 once
+one is empty; a denied request gets its other tokens back. Responses carry RateLimit-Limit / RateLimit-Remaining /
+RateLimit-Reset for the tightest bucket, and 429s a Retry-After.
+'''
+
+def parse_budgets(value):
+    """Returns {permission: (rate per second, burst)} from a RATE_LIMITS string
+    """
+    if isinstance(value, dict):
+        return value
+    budgets = {}
+    for item in filter(str.strip, value.split(',')):
+        match = BUDGET.match(item)
+        # a zero count, period or burst would never let a request through
+        if match is None or not all(int(number) for number in (match[2], match[3] or 1, match[5] or 1)):
+            raise ValueError(f'invalid rate limit {item.strip()!r}, expected e.g. "get:albums=60/m"')
+        permission, count, periods, unit, burst = match.groups()
+        seconds = int(periods or 1) * PERIODS[unit]
+        budgets[permission] = (int(count) / seconds, int(burst or count))
+    return budgets
+
+
+'''
+RateLimitStore
+Interface for token bucket stores. take() must refill and take
+atomically; a store shared by every worker (e.g. a Redis-compatible
+server running the refill as a script) only has to implement it.
+'''
+class RateLimitStore:
+    def take(self, key, rate, burst, cost=1):
+        """Takes `cost` tokens from bucket `key` if it has them
+
+        Returns (allowed, tokens left, seconds until the bucket is full,
+        or until `cost` tokens are back when not allowed).
+        """
+        raise NotImplementedError
+
+    def refund(self, key, rate, burst, cost=1):
+        """Gives back `cost` tokens taken from bucket `key`, up to `burst`
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+'''
+MemoryRateLimitStore
+Default in-process store: one bucket per key in a bounded LRU, so each
+worker enforces its own budget
+'''
+class MemoryRateLimitStore(RateLimitStore):
+    def __init__(self, maxsize=RATE_LIMIT_STORE_SIZE, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst, cost=1):
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        wait = (burst - tokens) / rate if allowed else (cost - tokens) / rate
+        return allowed, int(tokens), wait
+
+    def refund(self, key, rate, burst, cost=1):
+        now = self.clock()
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(burst, tokens + (now - updated) * rate + cost), now)
+
+
+class RateLimiter:
+    def __init__(self, budgets, store):
+        self.budgets = budgets
+        self.store = store
+
+    def check(self, client, permissions):
+        """Takes a token for each budgeted permission; aborts with 429 when one is empty
+
+        A denied request spends nothing: tokens already taken from the
+        other buckets are refunded.
+        """
+        tightest = None
+        taken = []
+        for permission in ['*'] + [permission for permission in permissions if permission != '*']:
+            if permission not in self.budgets:
+                continue
+            rate, burst = self.budgets[permission]
+            key = f'{client}|{permission}'
+            allowed, remaining, wait = self.store.take(key, rate, burst)
+            state = (allowed, burst, remaining, wait, rate)
+            if tightest is None or not allowed or remaining < tightest[2]:
+                tightest = state
+            if not allowed:
+                for key, rate, burst in taken:
+                    self.store.refund(key, rate, burst)
+                break
+            taken.append((key, rate, burst))
+        if tightest is not None:
+            g.rate_limit = tightest
+            if not tightest[0]:
+                abort(429)
+
+
+def check_rate_limit(client, permissions):
+    limiter = current_app.extensions.get('rate_limiter') if has_app_context() else None
+    if limiter is not None:
+        limiter.check(client, permissions)
+
+
+'''
+setup_rate_limits(app)
+    enforces RATE_LIMITS (app config or environment) in requires_auth;
+    does nothing without budgets
+'''
+def setup_rate_limits(app):
+    budgets = parse_budgets(app.config.get('RATE_LIMITS', RATE_LIMITS))
+    if not budgets:
+        return None
+    limiter = RateLimiter(budgets, app.config.get('RATE_LIMIT_STORE') or MemoryRateLimitStore(
+        maxsize=app.config.get('RATE_LIMIT_STORE_SIZE', RATE_LIMIT_STORE_SIZE)))
+    app.extensions['rate_limiter'] = limiter
+
+    @app.after_request
+    def rate_limit_headers(response):
+        if 'rate_limit' in g:
+            allowed, limit, remaining, wait, rate = g.rate_limit
+            response.headers['RateLimit-Limit'] = str(limit)
+            response.headers['RateLimit-Remaining'] = str(remaining)
+            response.headers['RateLimit-Reset'] = str(math.ceil(wait))
+            response.headers['RateLimit-Policy'] = f'{limit};w={max(round(limit / rate), 1)}'
+            if not allowed:
+                response.headers['Retry-After'] = str(math.ceil(wait))
+        return response
+
+    return limiter
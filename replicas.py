@@ -0,0 +1,153 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import create_engine
+
+from auth import auth_listeners
+from dbpool import engine_options
+from models import write_listeners
+from slowqueries import setup_slow_query_log
+
+# Comma-separated read replica URLs; unset means every query uses DATABASE_URL
+DATABASE_REPLICA_URLS = os.environ.get('DATABASE_REPLICA_URLS', '')
+# Seconds a client keeps reading from the primary after its own write
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# Recent writers remembered by the in-process sticky store (oldest are dropped)
+REPLICA_STICKY_CLIENTS = int(os.environ.get('REPLICA_STICKY_CLIENTS', 10000))
+# Set to 0 to stop setting the db_primary_until cookie
+REPLICA_STICKY_COOKIE = os.environ.get('REPLICA_STICKY_COOKIE', '1') == '1'
+
+STICKY_COOKIE = 'db_primary_until'
+READ_METHODS = ('GET', 'HEAD')
+
+'''
+Read replicas
+GET and HEAD requests read from a randomly chosen replica; every other
+request, and every query of a client that wrote within the last
+REPLICA_STICKY_SECONDS, uses the primary. Clients are the authenticated
+callers (auth.client_key: the token's `sub`, or the mock token name), so
+bearer-token clients read their own writes without keeping cookies.
+A write also sets a short-lived cookie holding the end of the window,
+which covers browsers whose next request lands on another worker.
+'''
+
+def _replica_urls(app):
+    urls = app.config.get('DATABASE_REPLICA_URLS', DATABASE_REPLICA_URLS)
+    if isinstance(urls, str):
+        urls = urls.split(',')
+    return [url.strip().replace('postgres://', 'postgresql://', 1) for url in urls if url.strip()]
+
+
+def _sticky():
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+'''
+StickyStore
+Interface for the "wrote recently" store. The in-process default is per
+worker; a store shared by every worker (e.g. a Redis-compatible server
+with expiring keys) only has to implement stick() and is_sticky().
+'''
+class StickyStore:
+    def stick(self, client, seconds):
+        """Routes `client`'s reads to the primary for the next `seconds`
+        """
+        raise NotImplementedError
+
+    def is_sticky(self, client):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+'''
+MemoryStickyStore
+Default store: the end of each client's window, in a bounded LRU
+'''
+class MemoryStickyStore(StickyStore):
+    def __init__(self, maxsize=REPLICA_STICKY_CLIENTS, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._until = OrderedDict()
+
+    def stick(self, client, seconds):
+        with self._lock:
+            self._until[client] = self.clock() + seconds
+            self._until.move_to_end(client)
+            while len(self._until) > self.maxsize:
+                self._until.popitem(last=False)
+
+    def is_sticky(self, client):
+        with self._lock:
+            until = self._until.get(client)
+            if until is not None and until <= self.clock():
+                del self._until[client]
+                until = None
+        return until is not None
+
+
+def use_primary_if_sticky(client):
+    # requires_auth runs before the view's first query
+    store = current_app.extensions.get('replica_sticky') if has_request_context() else None
+    if store is not None:
+        g.db_client = client
+        if store.is_sticky(client):
+            g.pop('db_replica', None)
+
+auth_listeners.append(use_primary_if_sticky)
+
+
+def mark_write(tables):
+    if has_request_context():
+        g.db_wrote = True
+
+write_listeners.append(mark_write)
+
+
+'''
+setup_replicas(app)
+    creates one engine per replica URL and routes the app's read requests
+    to them; does nothing without replicas
+'''
+def setup_replicas(app):
+    urls = _replica_urls(app)
+    if not urls:
+        return []
+    engines = [create_engine(url, **engine_options(url, app.config)) for url in urls]
+    for engine in engines:
+        setup_slow_query_log(app, engine)
+    app.extensions['db_replicas'] = engines
+    sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', REPLICA_STICKY_SECONDS)
+    sticky_cookie = app.config.get('REPLICA_STICKY_COOKIE', REPLICA_STICKY_COOKIE)
+    store = app.config.get('REPLICA_STICKY_STORE') or MemoryStickyStore(
+        maxsize=app.config.get('REPLICA_STICKY_CLIENTS', REPLICA_STICKY_CLIENTS))
+    app.extensions['replica_sticky'] = store
+
+    @app.before_request
+    def choose_replica():
+        if request.method in READ_METHODS and not (sticky_cookie and _sticky()):
+            g.db_replica = random.choice(engines)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.get('db_wrote'):
+            if g.get('db_client') is not None:
+                store.stick(g.db_client, sticky_seconds)
+            if sticky_cookie:
+                response.set_cookie(STICKY_COOKIE, str(time.time() + sticky_seconds),
+                                    max_age=sticky_seconds, httponly=True, samesite='Lax')
+        return response
+
+    return engines
@@ -0,0 +1,159 @@
+import re
+from contextlib import contextmanager
+from sqlalchemy import DDL, event, text
+
+from models import db, Artist, Album
+
+'''
+Full-text search
+Artist names and album titles are indexed by the database itself:
+
+- SQLite: FTS5 external-content tables (artists_fts, albums_fts) kept in
+  sync by triggers on artists/albums
+- Postgres: GIN indexes on to_tsvector('simple', ...)
+
+Both are maintained by the database on every write, including the bulk
+endpoints and writes made outside the models. They are created together
+with the tables; migration 0003 adds them to existing databases.
+'''
+
+SQLITE_DDL = {
+    Artist.__table__: [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS artists_fts USING fts5("
+        "name, content='artists', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS artists_fts_ai AFTER INSERT ON artists BEGIN "
+        "INSERT INTO artists_fts(rowid, name) VALUES (new.id, new.name); END",
+        "CREATE TRIGGER IF NOT EXISTS artists_fts_ad AFTER DELETE ON artists BEGIN "
+        "INSERT INTO artists_fts(artists_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+        "CREATE TRIGGER IF NOT EXISTS artists_fts_au AFTER UPDATE OF name ON artists BEGIN "
+        "INSERT INTO artists_fts(artists_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO artists_fts(rowid, name) VALUES (new.id, new.name); END",
+    ],
+    Album.__table__: [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS albums_fts USING fts5("
+        "title, content='albums', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS albums_fts_ai AFTER INSERT ON albums BEGIN "
+        "INSERT INTO albums_fts(rowid, title) VALUES (new.id, new.title); END",
+        "CREATE TRIGGER IF NOT EXISTS albums_fts_ad AFTER DELETE ON albums BEGIN "
+        "INSERT INTO albums_fts(albums_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+        "CREATE TRIGGER IF NOT EXISTS albums_fts_au AFTER UPDATE OF title ON albums BEGIN "
+        "INSERT INTO albums_fts(albums_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+        "INSERT INTO albums_fts(rowid, title) VALUES (new.id, new.title); END",
+    ],
+}
+
+POSTGRES_DDL = {
+    Artist.__table__: [
+        "CREATE INDEX IF NOT EXISTS ix_artists_name_fts ON artists USING gin (to_tsvector('simple', name))",
+    ],
+    Album.__table__: [
+        "CREATE INDEX IF NOT EXISTS ix_albums_title_fts ON albums USING gin (to_tsvector('simple', title))",
+    ],
+}
+
+for table, statements in SQLITE_DDL.items():
+    for statement in statements:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    # The FTS table outlives its content table otherwise
+    event.listen(table, 'before_drop',
+                 DDL(f'DROP TABLE IF EXISTS {table.name}_fts').execute_if(dialect='sqlite'))
+
+for table, statements in POSTGRES_DDL.items():
+    for statement in statements:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+
+@contextmanager
+def sqlite_bulk_load(connection):
+    """Suspends the SQLite FTS insert triggers of a raw DBAPI connection for a bulk load
+
+    Rebuilding the index once afterwards is about twice as fast as
+    indexing row by row. Does nothing where the triggers don't exist.
+    """
+    names = [f'{table.name}_fts_ai' for table in SQLITE_DDL]
+    cursor = connection.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN (?, ?)", names)
+    triggers = [row[0] for row in cursor.fetchall()]
+    for name in triggers:
+        cursor.execute(f'DROP TRIGGER {name}')
+    connection.commit()
+    try:
+        yield
+    finally:
+        for table, statements in SQLITE_DDL.items():
+            if f'{table.name}_fts_ai' in triggers:
+                cursor.execute(next(statement for statement in statements if f'{table.name}_fts_ai' in statement))
+                cursor.execute(f"INSERT INTO {table.name}_fts({table.name}_fts) VALUES ('rebuild')")
+        connection.commit()
+        cursor.close()
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Alembic autogenerate filter: the search tables and indexes are not in
+    the model metadata, so keep migrations from dropping them
+    """
+    return not (reflected and compare_to is None and '_fts' in (name or ''))
+
+
+SQLITE_SEARCH = {
+    'artists': "SELECT 'artist' AS kind, rowid AS id, -bm25(artists_fts) AS score "
+               "FROM artists_fts WHERE artists_fts MATCH :query",
+    'albums': "SELECT 'album' AS kind, rowid AS id, -bm25(albums_fts) AS score "
+              "FROM albums_fts WHERE albums_fts MATCH :query",
+}
+
+POSTGRES_SEARCH = {
+    'artists': "SELECT 'artist' AS kind, id, ts_rank(to_tsvector('simple', name), query) AS score "
+               "FROM artists, to_tsquery('simple', :query) query "
+               "WHERE to_tsvector('simple', name) @@ query",
+    'albums': "SELECT 'album' AS kind, id, ts_rank(to_tsvector('simple', title), query) AS score "
+              "FROM albums, to_tsquery('simple', :query) query "
+              "WHERE to_tsvector('simple', title) @@ query",
+}
+
+
+def search_terms(q):
+    """Splits user input into plain word tokens (safe to embed in FTS syntax)
+    """
+    return re.findall(r'\w+', q or '')
+
+
+def search_catalog(terms, kinds=('artists', 'albums'), limit=20, offset=0):
+    """Returns [(kind, id, score), ...] best match first
+
+    Every term matches as a prefix, so partially typed words find results.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        queries, query = SQLITE_SEARCH, ' '.join(f'"{term}"*' for term in terms)
+    elif dialect == 'postgresql':
+        queries, query = POSTGRES_SEARCH, ' & '.join(f'{term}:*' for term in terms)
+    else:
+        raise RuntimeError(f'full-text search is not supported on {dialect}')
+
+    statement = text(
+        'SELECT kind, id, score FROM (' +
+        ' UNION ALL '.join(queries[kind] for kind in kinds) +
+        ') AS matches ORDER BY score DESC, kind, id LIMIT :limit OFFSET :offset')
+    return db.session.execute(statement, {
+        'query': query, 'limit': limit, 'offset': offset
+    }).fetchall()
+
+
+def load_results(matches):
+    """Loads the matched rows (one query per kind) and formats them in rank order
+    """
+    ids = {'artist': [], 'album': []}
+    for kind, id, score in matches:
+        ids[kind].append(id)
+
+    rows = {}
+    if ids['artist']:
+        for artist in Artist.query.filter(Artist.id.in_(ids['artist'])):
+            rows['artist', artist.id] = artist.format_basic()
+    if ids['album']:
+        for album in Album.query.filter(Album.id.in_(ids['album'])):
+            rows['album', album.id] = dict(album.format_basic(), artist_id=album.artist_id)
+
+    return [dict(rows[kind, id], type=kind, score=round(score, 6))
+            for kind, id, score in matches if (kind, id) in rows]
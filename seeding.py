@@ -0,0 +1,190 @@
+import io
+import itertools
+import random
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+from models import db, Artist, Album, commit_write, reconcile_stats
+from search import sqlite_bulk_load
+
+# Rows written per transaction
+SEED_BATCH_SIZE = 100000
+
+# Relative weights, roughly the shape of a streaming catalog
+GENRES = {'Pop': 22, 'Rock': 18, 'Hip Hop': 16, 'Electronic': 10, 'R&B': 8, 'Country': 7,
+          'Jazz': 5, 'Metal': 5, 'Folk': 4, 'Classical': 3, 'Reggae': 2}
+COUNTRIES = {'USA': 35, 'UK': 12, 'Germany': 6, 'Japan': 6, 'Canada': 5, 'France': 5, 'Brazil': 4,
+             'Australia': 4, 'South Korea': 4, 'Sweden': 3, 'Nigeria': 3, 'Mexico': 3, 'Spain': 3,
+             'Italy': 3, 'Netherlands': 2, 'Ireland': 2}
+
+FIRST_NAMES = ['Ava', 'Leo', 'Maya', 'Noah', 'Zoe', 'Eli', 'Nina', 'Omar', 'Iris', 'Jonas', 'Lena',
+               'Mateo', 'Aiko', 'Sami', 'Clara', 'Dario', 'Freya', 'Kwame', 'Rosa', 'Theo']
+LAST_NAMES = ['Hart', 'Rivera', 'Okafor', 'Lind', 'Moreau', 'Tanaka', 'Silva', 'Brooks', 'Novak',
+              'Kim', 'Reyes', 'Walsh', 'Berg', 'Costa', 'Adler', 'Quinn', 'Mensah', 'Vega']
+WORDS = ['Midnight', 'Velvet', 'Echo', 'Neon', 'Harbor', 'Silver', 'Atlas', 'Crimson', 'Golden',
+         'Hollow', 'Static', 'Paper', 'Wild', 'Lunar', 'Electric', 'Quiet', 'Northern', 'Glass',
+         'River', 'Ember', 'Satellite', 'Honey', 'Ghost', 'Summer', 'Wolves', 'Signal', 'Coast']
+
+LATEST_YEAR = 2024
+
+'''
+Synthetic catalog seeder
+Generates artists and albums from a seeded random generator, so the same
+arguments always produce the same rows:
+
+- genres and countries follow the weights above; four in five albums
+  share their artist's genre
+- artist popularity is Pareto distributed, so album counts per artist
+  have a long tail
+- release dates lean towards recent years; track counts centre on 11
+
+Rows are streamed into the database without the ORM: COPY FROM STDIN on
+Postgres (psycopg2), executemany elsewhere, committing every
+`batch_size` rows. On SQLite the search index is rebuilt once at the end
+instead of row by row; Postgres maintains its expression indexes itself.
+The catalog counters are recounted and the catalog revisions bumped once
+at the end.
+'''
+
+def _weighted(rng, weights):
+    names, cumulative = list(weights), list(itertools.accumulate(weights.values()))
+    return lambda: rng.choices(names, cum_weights=cumulative)[0]
+
+
+def artist_rows(rng, count, first_id):
+    genre, country = _weighted(rng, GENRES), _weighted(rng, COUNTRIES)
+    for artist_id in range(first_id, first_id + count):
+        if rng.random() < 0.3:
+            name = f'The {rng.choice(WORDS)} {rng.choice(WORDS)}s'
+        else:
+            name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        age = min(max(round(rng.gauss(34, 11)), 16), 85)
+        yield (artist_id, name, age, genre(), country())
+
+
+def album_rows(rng, count, first_id, artist_ids, artist_genres):
+    genre = _weighted(rng, GENRES)
+    popularity = list(itertools.accumulate(rng.paretovariate(2.5) for _ in artist_ids))
+    for start in range(0, count, 1000):
+        picks = rng.choices(range(len(artist_ids)), cum_weights=popularity, k=min(1000, count - start))
+        for offset, pick in enumerate(picks):
+            year = LATEST_YEAR - min(int(rng.expovariate(1 / 12)), 64)
+            released = datetime(year, 1, 1) + timedelta(days=rng.randrange(365))
+            yield (first_id + start + offset,
+                   ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))),
+                   released,
+                   artist_genres[pick] if rng.random() < 0.8 else genre(),
+                   min(max(round(rng.gauss(11, 3)), 1), 30),
+                   artist_ids[pick])
+
+
+def _copy_text(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyStream(io.RawIOBase):
+    """Readable file of rows in COPY text format, produced as COPY reads it
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while len(self.buffer) < len(target):
+            lines = ['\t'.join(_copy_text(value) for value in row) + '\n'
+                     for row in itertools.islice(self.rows, 1000)]
+            if not lines:
+                break
+            self.buffer += ''.join(lines).encode()
+        size = min(len(target), len(self.buffer))
+        target[:size], self.buffer = self.buffer[:size], self.buffer[size:]
+        return size
+
+
+def write_rows(connection, table, rows, batch_size):
+    """Streams `rows` (tuples in `table` column order) into `table`, one transaction per batch
+    """
+    columns = [column.name for column in table.columns]
+    dialect = db.engine.dialect
+    cursor = connection.cursor()
+    if dialect.name == 'postgresql' and hasattr(cursor, 'copy_expert'):
+        statement = f"COPY {table.name} ({', '.join(columns)}) FROM STDIN"
+        write = lambda batch: cursor.copy_expert(statement, CopyStream(batch))
+    else:
+        marker = '?' if dialect.paramstyle == 'qmark' else '%s'
+        statement = f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES ({', '.join([marker] * len(columns))})"
+        # DBAPI drivers differ in how they store datetimes (SQLite keeps strings)
+        processors = [column.type.dialect_impl(dialect).bind_processor(dialect) for column in table.columns]
+        if any(processors):
+            rows = (tuple(process(value) if process else value for process, value in zip(processors, row))
+                    for row in rows)
+        write = lambda batch: cursor.executemany(statement, batch)
+
+    try:
+        while True:
+            batch = itertools.islice(rows, batch_size)
+            first = next(batch, None)
+            if first is None:
+                break
+            write(itertools.chain([first], batch))
+            connection.commit()
+    except Exception:
+        # committed batches stay; the failed one is dropped
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+'''
+seed_catalog(artists, albums, seed=0, batch_size=SEED_BATCH_SIZE)
+    appends `artists` artists and `albums` albums (spread over the new
+    artists) to the catalog; returns the number of seconds it took
+'''
+def seed_catalog(artists, albums, seed=0, batch_size=SEED_BATCH_SIZE):
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    first_artist = (db.session.query(db.func.max(Artist.id)).scalar() or 0) + 1
+    first_album = (db.session.query(db.func.max(Album.id)).scalar() or 0) + 1
+    db.session.commit()
+
+    artist_ids, artist_genres = [], []
+
+    def remember(rows):
+        for row in rows:
+            artist_ids.append(row[0])
+            artist_genres.append(row[3])
+            yield row
+
+    connection = db.engine.raw_connection()
+    sqlite = db.engine.dialect.name == 'sqlite'
+    try:
+        with sqlite_bulk_load(connection) if sqlite else nullcontext():
+            write_rows(connection, Artist.__table__, remember(artist_rows(rng, artists, first_artist)),
+                       batch_size)
+            if albums and artist_ids:
+                write_rows(connection, Album.__table__,
+                           album_rows(rng, albums, first_album, artist_ids, artist_genres), batch_size)
+        if db.engine.dialect.name == 'postgresql':
+            # ids were given explicitly; move the sequences past them
+            cursor = connection.cursor()
+            for table in ('artists', 'albums'):
+                cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                               f"COALESCE(MAX(id), 1)) FROM {table}")
+            cursor.close()
+            connection.commit()
+    finally:
+        connection.close()
+
+    reconcile_stats()
+    commit_write('artists', 'albums', 'catalog_stats')
+    return time.perf_counter() - started
@@ -0,0 +1,145 @@
+import os
+from datetime import date
+from operator import itemgetter
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import func
+
+from models import db, Artist, Album
+from profiling import count_rows, phase
+
+try:
+    import orjson
+except ImportError:  # pinned in requirements.txt; the stdlib encoder covers its absence
+    orjson = None
+
+# Set to 0 to keep the stdlib encoder even when orjson is installed
+USE_ORJSON = os.environ.get('USE_ORJSON', '1') == '1'
+
+# The dumps() arguments of a compact (non-debug) response()
+COMPACT = {'separators': (',', ':')}
+
+'''
+JSONProvider
+Flask JSON provider that encodes with orjson when it is installed and
+falls back to the stdlib encoder otherwise. Dates are written as
+YYYY-MM-DD by both, so rows can carry date values as they come from the
+database instead of formatting them one by one.
+'''
+class JSONProvider(DefaultJSONProvider):
+    use_orjson = orjson is not None and USE_ORJSON
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        # response() asks for compact separators, which is all orjson writes;
+        # pretty printing (debug mode) and other arguments go to the stdlib
+        if not self.use_orjson or kwargs not in ({}, COMPACT):
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def response(self, *args, **kwargs):
+        with phase('serialize'):
+            return super().response(*args, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if not self.use_orjson or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+'''
+Tuple rows
+Read-only list endpoints select the requested columns as plain result
+tuples and build the output rows from them, without ORM instances,
+identity map bookkeeping or per-row format() calls. The output is the
+same as RowFormatter's.
+'''
+
+def _column(model, name, label=None):
+    if name == 'release_date':
+        # date() returns the day only: a date on Postgres, 'YYYY-MM-DD' on SQLite
+        return func.date(model.release_date).label(label or name)
+    column = getattr(model, name)
+    return column.label(label) if label else column
+
+
+def _getter(indexes):
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    return itemgetter(*indexes)
+
+
+class TupleRows:
+    """Selects and encodes the rows described by a RowFormatter
+
+    The id is always selected first (for cursors and embedding); fields
+    are picked out of each result tuple by position.
+    """
+
+    def __init__(self, formatter):
+        self.formatter = formatter
+        self.model = formatter.model
+        self.fields = list(formatter.fields)
+        self.include = formatter.include
+        self.columns = formatter.columns
+
+        self.selected = ['id'] + [field for field in self.fields if field != 'id']
+        self.row_fields = _getter([self.selected.index(field) for field in self.fields])
+
+    def query(self, criteria=()):
+        columns = [_column(self.model, name) for name in self.selected]
+        query = db.session.query(*columns)
+        if self.include and self.model is Album:
+            # many-to-one: the artist comes from an outer join in the same query
+            query = query.add_columns(*[
+                _column(Artist, name, 'artist__' + name) for name in self.formatter.basic_columns
+            ]).outerjoin(Artist, Album.artist_id == Artist.id)
+        return query.filter(*criteria)
+
+    def _embedded_artists(self, rows):
+        start = len(self.selected)
+        keys = self.formatter.basic_columns
+        return [dict(zip(keys, row[start:])) if row[start] is not None else None for row in rows]
+
+    def _embedded_albums(self, rows, criteria):
+        ids = [row[0] for row in rows]
+        if not ids:
+            return []
+        albums = {artist_id: [] for artist_id in ids}
+        keys = self.formatter.basic_columns
+        query = db.session.query(Album.artist_id, *[_column(Album, name) for name in keys])
+        if criteria is None:
+            query = query.filter(Album.artist_id.in_(ids))
+        elif criteria:
+            query = query.filter(Album.artist_id.in_(db.session.query(Artist.id).filter(*criteria)))
+        embedded = 0
+        for row in query.order_by(Album.id):
+            if row[0] in albums:
+                albums[row[0]].append(dict(zip(keys, row[1:])))
+                embedded += 1
+        count_rows(embedded)
+        return [albums[artist_id] for artist_id in ids]
+
+    def encode(self, collection, rows, compact=False, criteria=None):
+        """Returns {collection: rows}, plus a `columns` header in compact mode
+
+        Pass the list `criteria` when `rows` is the whole filtered list
+        (not a page): embedded albums are then selected with the same
+        criteria instead of by id, so the query does not grow with the list.
+        """
+        with phase('serialize'):
+            count_rows(len(rows))
+            values = [self.row_fields(row) for row in rows]
+            if self.include:
+                embedded = (self._embedded_albums(rows, criteria) if self.model is Artist
+                            else self._embedded_artists(rows))
+                values = [value + (related,) for value, related in zip(values, embedded)]
+            if compact:
+                return {'columns': self.columns, collection: values}
+            return {collection: [dict(zip(self.columns, value)) for value in values]}
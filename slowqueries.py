@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timezone
+from flask import has_request_context, request
+from sqlalchemy import event
+
+# Statements slower than this (ms) are logged; 0 logs every statement
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+# Slow statements kept in memory per worker for GET /internal/slow-queries
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100))
+# Set to 0 to skip the EXPLAIN of each slow statement
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', '1') == '1'
+
+EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+
+logger = logging.getLogger(__name__)
+
+'''
+Slow query log
+Engine events time every statement; one that takes longer than
+SLOW_QUERY_MS is logged (logger "slowqueries", level WARNING) and kept in
+a bounded ring buffer together with:
+
+- its bind parameters, with strings and bytes redacted
+- the route of the request that issued it
+- its plan: EXPLAIN (ANALYZE off) on Postgres, EXPLAIN QUERY PLAN on SQLite
+
+The plan is read on the same connection right after the statement, with
+the same parameters, through a raw cursor so it is not timed or logged
+itself. On Postgres it runs inside a savepoint, so a failing EXPLAIN
+does not abort the request's transaction.
+'''
+
+def redact(value):
+    if isinstance(value, (str, bytes)):
+        return '<redacted>'
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def explain(connection, statement, parameters):
+    """Returns the plan of `statement` as a list of lines, or None
+
+    Only SELECT and DML statements on Postgres and SQLite are explained;
+    the statement is never executed again.
+    """
+    if not statement.lstrip().lower().startswith(EXPLAINABLE):
+        return None
+    backend = connection.dialect.name
+    if backend == 'postgresql':
+        query = 'EXPLAIN (ANALYZE off) ' + statement
+    elif backend == 'sqlite':
+        query = 'EXPLAIN QUERY PLAN ' + statement
+    else:
+        return None
+
+    cursor = connection.connection.cursor()
+    try:
+        if backend == 'postgresql':
+            cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(query, parameters)
+            rows = cursor.fetchall()
+        except Exception as error:
+            if backend == 'postgresql':
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return [f'EXPLAIN failed: {error}']
+        finally:
+            if backend == 'postgresql':
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+    finally:
+        cursor.close()
+    if backend == 'sqlite':
+        # (id, parent, notused, detail)
+        return [row[-1] for row in rows]
+    return [row[0] for row in rows]
+
+
+'''
+SlowQueryLog
+Ring buffer of the last `size` slow statements of the engines it listens to
+'''
+class SlowQueryLog:
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, size=SLOW_QUERY_LOG_SIZE, explain=SLOW_QUERY_EXPLAIN):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=size)
+        self.count = 0
+
+    def listen(self, engine):
+        if not event.contains(engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(engine, 'handle_error', self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_started', []).append(time.perf_counter())
+
+    def _handle_error(self, exception_context):
+        started = exception_context.connection.info.get('slow_query_started')
+        if started:
+            started.pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration_ms = (time.perf_counter() - conn.info['slow_query_started'].pop()) * 1000
+        if duration_ms >= self.threshold_ms:
+            self.record(conn, statement, parameters, executemany, duration_ms)
+
+    def record(self, conn, statement, parameters, executemany, duration_ms):
+        entry = {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'duration_ms': round(duration_ms, 3),
+            'statement': statement,
+            'parameters': redact(parameters[0] if executemany and parameters else parameters),
+            'executemany': len(parameters) if executemany else None,
+            'route': (f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+                      if has_request_context() else None),
+            'plan': None
+        }
+        if self.explain and not executemany:
+            try:
+                entry['plan'] = explain(conn, statement, parameters)
+            except Exception as error:
+                entry['plan'] = [f'EXPLAIN failed: {error}']
+        logger.warning('slow query (%.1f ms) from %s: %s', duration_ms, entry['route'] or '-', statement)
+        with self._lock:
+            self._entries.append(entry)
+            self.count += 1
+
+    def entries(self):
+        """Returns the kept slow statements, newest first
+        """
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.count = 0
+
+    def stats(self):
+        return {
+            'threshold_ms': self.threshold_ms,
+            'count': self.count,
+            'entries': self.entries()
+        }
+
+
+'''
+setup_slow_query_log(app, engine)
+    times the statements of `engine` with the app's slow query log,
+    creating the log on first use
+'''
+def setup_slow_query_log(app, engine):
+    log = app.extensions.get('slow_queries')
+    if log is None:
+        log = app.extensions['slow_queries'] = SlowQueryLog(
+            threshold_ms=app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS),
+            size=app.config.get('SLOW_QUERY_LOG_SIZE', SLOW_QUERY_LOG_SIZE),
+            explain=app.config.get('SLOW_QUERY_EXPLAIN', SLOW_QUERY_EXPLAIN))
+    log.listen(engine)
+    return log
@@ -0,0 +1,46 @@
+import os
+from flask import Response, current_app, request, stream_with_context, abort
+
+# Rows fetched from the database cursor per round trip while streaming
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+
+'''
+Streaming exports
+`?stream=1` on a list endpoint emits the rows one at a time from a
+server-side cursor instead of building the whole list and JSON string
+in memory. `&format=ndjson` switches to one JSON object per line.
+'''
+
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def stream_query(query, format_row, collection):
+    """Returns a streaming Response for every row of `query`
+
+    `collection` is the list key of the regular endpoint, e.g. 'artists';
+    the JSON body ends with the matching `total_<collection>` count.
+    """
+    output = request.args.get('format', 'json')
+    if output not in ('json', 'ndjson'):
+        abort(400)
+
+    # yield_per also turns on stream_results (server-side cursor on Postgres)
+    rows = query.yield_per(STREAM_BATCH_SIZE)
+    dumps = current_app.json.dumps
+
+    def generate_ndjson():
+        for row in rows:
+            yield dumps(format_row(row)) + '\n'
+
+    def generate_json():
+        yield '{"success": true, "%s": [' % collection
+        total = 0
+        for row in rows:
+            yield (',' if total else '') + dumps(format_row(row))
+            total += 1
+        yield '], "total_%s": %d}' % (collection, total)
+
+    if output == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
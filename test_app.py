@@ -1,11 +1,95 @@
+import asyncio
+import importlib.util
 import os
+import subprocess
+import sys
+import tempfile
 import unittest
 import json
+import base64
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
+# Tests run against scratch SQLite files, so let setup_db create the schema
+os.environ.setdefault('DB_CREATE_SCHEMA', '1')
+
+import rsa
+from jose import jwt
+from sqlalchemy import create_engine, event, func, inspect, text
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+import auth
+import dbpool
+import replicas
+import pagination
+import profiling
+import ratelimit
+import seeding
+import serialization
+import slowqueries
 from app import create_app
-from models import setup_db, Artist, Album
+from models import (setup_db, db, Artist, Album, catalog_version, commit_write, get_stats, reconcile_stats,
+                    CatalogRevision, CatalogStat)
+
+
+@contextmanager
+def count_queries(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def b64url_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+class JWKSServer:
+    """Local stand-in for the Auth0 /.well-known/jwks.json endpoint"""
+
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.requests = 0
+        self.fail = False
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if server.fail:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                body = json.dumps(server.jwks).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/.well-known/jwks.json'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
 class MusicLabelTestCase(unittest.TestCase):
     """This class represents the music label test case"""
@@ -59,6 +143,45 @@ class MusicLabelTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['total_artists'])
 
+    def test_get_artist_success(self):
+        """Test GET /artists/<id> success"""
+        artist_id, album_ids = self.create_artist_with_albums()
+        res = self.client().get(f'/artists/{artist_id}', headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['artist']['id'], artist_id)
+        self.assertEqual([album['id'] for album in data['artist']['albums']], album_ids)
+        self.assertIn('ETag', res.headers)
+
+    def test_get_artist_not_found(self):
+        """Test GET /artists/<id> with invalid id"""
+        res = self.client().get('/artists/999999', headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_album_success(self):
+        """Test GET /albums/<id> success and conditional GET"""
+        artist_id, album_ids = self.create_artist_with_albums(albums=1)
+        res = self.client().get(f'/albums/{album_ids[0]}', headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['album']['artist']['id'], artist_id)
+
+        headers = dict(self.assistant_headers, **{'If-None-Match': res.headers['ETag']})
+        res = self.client().get(f'/albums/{album_ids[0]}', headers=headers)
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_album_forbidden_without_token(self):
+        """Test GET /albums/<id> without authorization"""
+        res = self.client().get('/albums/1')
+
+        self.assertEqual(res.status_code, 401)
+
     def test_get_artists_unauthorized(self):
         """Test GET /artists without authorization"""
         res = self.client().get('/artists')
@@ -112,7 +235,7 @@ class MusicLabelTestCase(unittest.TestCase):
     def test_patch_artist_not_found(self):
         """Test PATCH /artists/<id> with invalid id"""
         update_data = {'age': 30}
-        res = self.client().patch('/artists/999', json=update_data, headers=self.director_headers)
+        res = self.client().patch('/artists/999999', json=update_data, headers=self.director_headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -141,6 +264,318 @@ class MusicLabelTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertEqual(data['success'], False)
 
+    # Tests for pagination
+    def test_get_artists_paginated(self):
+        """Test GET /artists walks all pages with limit/cursor"""
+        created = []
+        for _ in range(3):
+            res = self.client().post('/artists', json=self.new_artist, headers=self.director_headers)
+            created.append(json.loads(res.data)['created'])
+
+        seen = []
+        cursor = pagination.encode_cursor(created[0] - 1)
+        while cursor:
+            res = self.client().get(f'/artists?limit=2&cursor={cursor}', headers=self.assistant_headers)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['artists']), 2)
+            self.assertTrue(data['total_artists'] >= 3)
+            seen.extend(artist['id'] for artist in data['artists'])
+            cursor = data['next_cursor']
+
+        self.assertEqual(seen[:3], created)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_get_albums_page_size_capped(self):
+        """Test GET /albums never returns more than MAX_PAGE_SIZE rows"""
+        res = self.client().get('/albums?limit=100000', headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data['albums']), pagination.MAX_PAGE_SIZE)
+        self.assertIn('next_cursor', data)
+
+    def test_get_artists_invalid_cursor(self):
+        """Test GET /artists with a malformed cursor"""
+        res = self.client().get('/artists?cursor=not-a-cursor', headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_artists_invalid_limit(self):
+        """Test GET /artists with a non-positive limit"""
+        res = self.client().get('/artists?limit=0', headers=self.assistant_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    # Tests for filters
+    def test_get_artists_filtered(self):
+        """Test GET /artists with genre, country, age range and name prefix"""
+        artist_id, _ = self.create_artist_with_albums(albums=0)
+        name = f'Filter_%Artist {artist_id}'
+        self.client().patch(f'/artists/{artist_id}', json={'name': name, 'genre': 'Filter Genre', 'age': 41},
+                            headers=self.director_headers)
+
+        res = self.client().get('/artists', query_string={
+            'genre': 'Filter Genre', 'country': 'USA', 'min_age': 40, 'max_age': 41, 'name_prefix': 'Filter_%'
+        }, headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(artist_id, [artist['id'] for artist in data['artists']])
+        for artist in data['artists']:
+            self.assertEqual(artist['genre'], 'Filter Genre')
+            self.assertTrue(artist['name'].startswith('Filter_%'))
+
+        res = self.client().get('/artists', query_string={'genre': 'Filter Genre', 'name_prefix': 'FilterX'},
+                                headers=self.assistant_headers)
+        self.assertEqual(json.loads(res.data)['artists'], [])
+
+    def test_get_albums_filtered(self):
+        """Test GET /albums with artist, release date and track count ranges"""
+        artist_id, album_ids = self.create_artist_with_albums()
+        self.client().patch(f'/albums/{album_ids[1]}', json={'release_date': '2023-06-01', 'track_count': 20},
+                            headers=self.director_headers)
+
+        res = self.client().get('/albums', query_string={
+            'artist_id': artist_id, 'released_after': '2023-01-01', 'released_before': '2023-12-31',
+            'min_tracks': 15, 'limit': 10
+        }, headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([album['id'] for album in data['albums']], [album_ids[1]])
+        self.assertEqual(data['total_albums'], 1)
+
+    def test_get_albums_invalid_filter(self):
+        """Test GET /albums with a malformed date filter"""
+        res = self.client().get('/albums?released_after=yesterday', headers=self.assistant_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    # Tests for sparse fieldsets and compact encoding
+    def test_get_albums_with_fields_and_include(self):
+        """Test GET /albums?fields=&include= picks columns and relationships"""
+        self.create_artist_with_albums(albums=1)
+        res = self.client().get('/albums?fields=title,release_date&include=artist&limit=1',
+                                headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['albums'][0]), {'title', 'release_date', 'artist'})
+        self.assertEqual(set(data['albums'][0]['artist']), {'id', 'name', 'genre', 'country'})
+
+        res = self.client().get('/albums?fields=title&limit=1', headers=self.assistant_headers)
+        self.assertEqual(set(json.loads(res.data)['albums'][0]), {'title'})
+
+    def test_default_rows_match_format(self):
+        """Test rows without fields/include are exactly Model.format()"""
+        artist_id, _ = self.create_artist_with_albums(albums=2)
+        cursor = pagination.encode_cursor(artist_id - 1)
+        data = json.loads(self.client().get(f'/artists?limit=1&cursor={cursor}', headers=self.assistant_headers).data)
+
+        with self.app.app_context():
+            self.assertEqual(data['artists'][0], db.session.get(Artist, artist_id).format())
+
+    def test_get_artists_compact(self):
+        """Test GET /artists?format=compact returns a header and row arrays"""
+        self.create_artist_with_albums(albums=0)
+        res = self.client().get('/artists?format=compact&fields=id,name&include=', headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['columns'], ['id', 'name'])
+        self.assertTrue(all(len(row) == 2 for row in data['artists']))
+        self.assertEqual(data['total_artists'], len(data['artists']))
+
+    def test_get_artists_unknown_field(self):
+        """Test GET /artists with a field that does not exist"""
+        res = self.client().get('/artists?fields=id,password', headers=self.assistant_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    # Tests for streaming exports
+    def test_stream_artists_json(self):
+        """Test GET /artists?stream=1 matches the regular list"""
+        self.client().post('/artists', json=self.new_artist, headers=self.director_headers)
+        full = json.loads(self.client().get('/artists', headers=self.assistant_headers).data)
+        res = self.client().get('/artists?stream=1', headers=self.assistant_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data, full)
+
+    def test_stream_albums_ndjson(self):
+        """Test GET /albums?stream=1&format=ndjson emits one album per line"""
+        full = json.loads(self.client().get('/albums', headers=self.assistant_headers).data)
+        res = self.client().get('/albums?stream=1&format=ndjson', headers=self.assistant_headers)
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in lines], full['albums'])
+
+    def test_stream_invalid_format(self):
+        """Test GET /albums?stream=1 with an unknown format"""
+        res = self.client().get('/albums?stream=1&format=xml', headers=self.assistant_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    # Tests for bulk inserts
+    def test_bulk_create_artists_and_albums(self):
+        """Test POST /artists/bulk and POST /albums/bulk success"""
+        with self.app.app_context():
+            artists_before = Artist.query.count()
+            albums_before = Album.query.count()
+
+        artists = [dict(self.new_artist, name=f'Bulk Artist {n}') for n in range(5)]
+        res = self.client().post('/artists/bulk', json={'artists': artists}, headers=self.executive_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 5)
+
+        with self.app.app_context():
+            self.assertEqual(Artist.query.count(), artists_before + 5)
+            artist_id = Artist.query.order_by(Artist.id.desc()).first().id
+
+        albums = [dict(self.new_album, title=f'Bulk Album {n}', artist_id=artist_id) for n in range(5)]
+        res = self.client().post('/albums/bulk', json={'albums': albums}, headers=self.executive_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 5)
+
+        with self.app.app_context():
+            self.assertEqual(Album.query.count(), albums_before + 5)
+
+    def test_bulk_create_albums_reports_item_errors(self):
+        """Test POST /albums/bulk rejects the whole batch with per-item errors"""
+        with self.app.app_context():
+            albums_before = Album.query.count()
+            missing_artist = (Artist.query.with_entities(func.max(Artist.id)).scalar() or 0) + 1000
+
+        albums = [
+            dict(self.new_album, release_date='01/01/2024'),
+            dict(self.new_album, artist_id=missing_artist),
+            {'title': 'No genre'}
+        ]
+        res = self.client().post('/albums/bulk', json={'albums': albums}, headers=self.executive_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual([error['index'] for error in data['errors']], [0, 1, 2])
+        with self.app.app_context():
+            self.assertEqual(Album.query.count(), albums_before)
+
+    def test_bulk_create_artists_forbidden(self):
+        """Test POST /artists/bulk with insufficient permissions"""
+        res = self.client().post('/artists/bulk', json={'artists': [self.new_artist]}, headers=self.assistant_headers)
+
+        self.assertEqual(res.status_code, 403)
+
+    def test_bulk_create_artists_empty(self):
+        """Test POST /artists/bulk with an empty batch"""
+        res = self.client().post('/artists/bulk', json={'artists': []}, headers=self.director_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    # Tests for bulk updates and deletes
+    def create_artist_with_albums(self, albums=2):
+        res = self.client().post('/artists', json=self.new_artist, headers=self.executive_headers)
+        artist_id = json.loads(res.data)['created']
+        album_ids = []
+        for _ in range(albums):
+            album_data = dict(self.new_album, artist_id=artist_id)
+            res = self.client().post('/albums', json=album_data, headers=self.executive_headers)
+            album_ids.append(json.loads(res.data)['created'])
+        return artist_id, album_ids
+
+    def test_bulk_patch_albums(self):
+        """Test PATCH /albums/bulk updates every listed album"""
+        artist_id, album_ids = self.create_artist_with_albums()
+        body = {'ids': album_ids, 'changes': {'genre': 'Jazz', 'release_date': '2020-02-02'}}
+        res = self.client().patch('/albums/bulk', json=body, headers=self.director_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 2)
+        with self.app.app_context():
+            for album in Album.query.filter(Album.id.in_(album_ids)):
+                self.assertEqual(album.genre, 'Jazz')
+                self.assertEqual(album.release_date, datetime(2020, 2, 2))
+
+    def test_bulk_patch_artists_by_filter(self):
+        """Test PATCH /artists/bulk with a filter"""
+        artist_id, _ = self.create_artist_with_albums(albums=0)
+        country = f'Country {artist_id}'
+        self.client().patch(f'/artists/{artist_id}', json={'country': country}, headers=self.director_headers)
+
+        body = {'filter': {'country': country}, 'changes': {'age': 44}}
+        res = self.client().patch('/artists/bulk', json=body, headers=self.director_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 1)
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Artist, artist_id).age, 44)
+
+    def test_bulk_patch_unknown_field(self):
+        """Test PATCH /artists/bulk rejects fields that are not artist columns"""
+        body = {'ids': [1], 'changes': {'id': 5}}
+        res = self.client().patch('/artists/bulk', json=body, headers=self.director_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_bulk_patch_invalid_values(self):
+        """Test PATCH /artists/bulk and /albums/bulk reject values of the wrong type"""
+        with count_queries(db.engine) as statements:
+            for path, changes, headers in (
+                    ('/artists/bulk', {'age': 'old'}, self.director_headers),
+                    ('/artists/bulk', {'name': ''}, self.director_headers),
+                    ('/artists/bulk', {'age': True}, self.director_headers),
+                    ('/albums/bulk', {'artist_id': {'x': 1}}, self.director_headers),
+                    ('/albums/bulk', {'track_count': 9.5}, self.director_headers),
+                    ('/albums/bulk', {'title': None}, self.director_headers)):
+                res = self.client().patch(path, json={'ids': [1], 'changes': changes}, headers=headers)
+                self.assertEqual(res.status_code, 400, changes)
+                self.assertEqual(json.loads(res.data)['message'], 'bad request')
+        self.assertEqual(statements, [])
+
+    def test_bulk_delete_artists_cascades_albums(self):
+        """Test DELETE /artists/bulk also removes the artists' albums"""
+        artist_id, album_ids = self.create_artist_with_albums()
+        res = self.client().delete('/artists/bulk', json={'ids': [artist_id]}, headers=self.director_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 1)
+        with self.app.app_context():
+            self.assertIsNone(db.session.get(Artist, artist_id))
+            self.assertEqual(Album.query.filter(Album.id.in_(album_ids)).count(), 0)
+
+    def test_bulk_delete_albums_by_filter(self):
+        """Test DELETE /albums/bulk with a filter"""
+        artist_id, album_ids = self.create_artist_with_albums()
+        body = {'filter': {'artist_id': artist_id}}
+        res = self.client().delete('/albums/bulk', json=body, headers=self.executive_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+
+    def test_bulk_delete_requires_criteria(self):
+        """Test DELETE /albums/bulk refuses an empty or ambiguous selection"""
+        for body in ({}, {'filter': {}}, {'ids': [1], 'filter': {'genre': 'Pop'}}):
+            res = self.client().delete('/albums/bulk', json=body, headers=self.executive_headers)
+            self.assertEqual(res.status_code, 400)
+
+    def test_bulk_delete_albums_forbidden(self):
+        """Test DELETE /albums/bulk with insufficient permissions"""
+        res = self.client().delete('/albums/bulk', json={'ids': [1]}, headers=self.director_headers)
+
+        self.assertEqual(res.status_code, 403)
+
     # Tests for Albums endpoint
     def test_get_albums_success(self):
         """Test GET /albums success"""
@@ -251,6 +686,1126 @@ class MusicLabelTestCase(unittest.TestCase):
         res = self.client().delete(f'/albums/{album_id}', headers=self.executive_headers)
         self.assertEqual(res.status_code, 200)
 
+class QueryCountTestCase(unittest.TestCase):
+    """List endpoints must not issue one query per row"""
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, "sqlite:///test.db")
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer assistant'}
+
+    def seed(self, count):
+        with self.app.app_context():
+            for n in range(count):
+                artist = Artist(name=f'Query Artist {n}', age=30, genre='Rock', country='UK')
+                artist.insert()
+                Album(title=f'Query Album {n}', release_date=datetime(2020, 1, 1),
+                      genre='Rock', track_count=9, artist_id=artist.id).insert()
+
+    def queries_for(self, path):
+        with self.app.app_context():
+            with count_queries(db.engine) as statements:
+                res = self.client.get(path, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return len(statements)
+
+    def test_sparse_fieldset_skips_unselected_columns_and_relationships(self):
+        self.seed(2)
+        with self.app.app_context():
+            with count_queries(db.engine) as statements:
+                res = self.client.get('/artists?fields=id,name&limit=5', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['artists'][0]), {'id', 'name'})
+        listing = [statement for statement in statements if 'FROM artists' in statement and 'count' not in statement]
+        self.assertEqual(len(listing), 1)
+        self.assertNotIn('artists.age', listing[0])
+        self.assertFalse(any('FROM albums' in statement for statement in statements))
+
+    def test_artists_query_count_is_constant(self):
+        self.seed(3)
+        before = self.queries_for('/artists')
+        self.seed(10)
+        self.assertEqual(self.queries_for('/artists'), before)
+        # catalog version, artists, albums
+        self.assertLessEqual(before, 3)
+
+    def test_albums_query_count_is_constant(self):
+        self.seed(3)
+        before = self.queries_for('/albums')
+        self.seed(10)
+        self.assertEqual(self.queries_for('/albums'), before)
+        # catalog version, albums joined with artists
+        self.assertEqual(before, 2)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """Response cache on the list endpoints"""
+
+    def setUp(self):
+        self.app = create_app({'INTERNAL_ENDPOINTS': True, 'RESPONSE_CACHE_SIZE': 2})
+        setup_db(self.app, "sqlite:///test.db")
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer executive'}
+
+    def stats(self):
+        return json.loads(self.client.get('/internal/cache').data)['response_cache']
+
+    def test_repeated_get_is_served_from_cache(self):
+        first = self.client.get('/artists?limit=5', headers=self.headers)
+        with self.app.app_context():
+            with count_queries(db.engine) as statements:
+                second = self.client.get('/artists?limit=5', headers=self.headers)
+
+        self.assertEqual(second.data, first.data)
+        # Only the catalog version is read
+        self.assertEqual(len(statements), 1)
+        stats = self.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_write_invalidates_cached_lists(self):
+        self.client.get('/albums', headers=self.headers)
+        res = self.client.post('/artists', json={'name': 'Cache Artist', 'age': 30, 'genre': 'Pop', 'country': 'USA'},
+                               headers=self.headers)
+        artist_id = json.loads(res.data)['created']
+        album = {'title': 'Cache Album', 'release_date': '2024-01-01', 'genre': 'Pop', 'artist_id': artist_id}
+        album_id = json.loads(self.client.post('/albums', json=album, headers=self.headers).data)['created']
+
+        data = json.loads(self.client.get('/albums', headers=self.headers).data)
+        self.assertIn(album_id, [album['id'] for album in data['albums']])
+        self.assertEqual(self.stats()['invalidations'], 1)
+
+    def test_cache_checks_permissions(self):
+        self.client.get('/artists', headers=self.headers)
+        res = self.client.get('/artists')
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for limit in (1, 2, 3):
+            self.client.get(f'/albums?limit={limit}', headers=self.headers)
+        stats = self.stats()
+
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_response_computed_before_write_is_not_stored(self):
+        cache = self.app.extensions['response_cache']
+        generation = cache.generation
+        cache.invalidate('artists')
+        cache.set('/artists?', b'{}', ('artists',), generation)
+
+        self.assertIsNone(cache.get('/artists?'))
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """Pool settings and pool metrics"""
+
+    def test_engine_options_from_config(self):
+        options = dbpool.engine_options('postgresql://localhost/music',
+                                        {'DB_POOL_SIZE': 2, 'DB_POOL_PRE_PING': False})
+        self.assertIs(options['poolclass'], dbpool.TimedQueuePool)
+        self.assertEqual(options['pool_size'], 2)
+        self.assertEqual(options['max_overflow'], dbpool.DB_MAX_OVERFLOW)
+        self.assertFalse(options['pool_pre_ping'])
+
+        # SQLite has no connection queue to size
+        self.assertNotIn('pool_size', dbpool.engine_options('sqlite:///test.db'))
+
+    def test_checkout_waits_and_timeouts_are_recorded(self):
+        engine = create_engine('sqlite://', poolclass=dbpool.TimedQueuePool, pool_size=1, max_overflow=0,
+                               pool_timeout=0.05, connect_args={'check_same_thread': False})
+        metrics = dbpool.PoolMetrics(engine)
+        connection = engine.connect()
+        stats = metrics.snapshot()
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['checkout_wait_ms']['count'], 1)
+
+        with self.assertRaises(PoolTimeout):
+            engine.connect()
+        connection.close()
+        engine.dispose()
+        engine.connect().close()
+
+        stats = metrics.snapshot()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checkout_wait_ms']['count'], 2)
+        self.assertEqual(stats['checkout_wait_ms']['buckets']['+Inf'], 2)
+
+    def test_pool_endpoint(self):
+        app = create_app({'INTERNAL_ENDPOINTS': True})
+        setup_db(app, "sqlite:///test.db")
+        client = app.test_client()
+        client.get('/artists', headers={'Authorization': 'Bearer assistant'})
+        stats = json.loads(client.get('/internal/pool').data)['pool']
+
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertGreater(stats['checkouts'], 0)
+        self.assertEqual(create_app().test_client().get('/internal/pool').status_code, 404)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """Per-route phase timings, SQL counts, /metrics and the cProfile sampler"""
+
+    def make_client(self, **config):
+        app = create_app({'RESPONSE_CACHE_ENABLED': False, **config})
+        setup_db(app, "sqlite:///test.db")
+        return app.test_client()
+
+    def test_phases_are_charged_to_the_innermost(self):
+        now = [0.0]
+        profile = profiling.RequestProfile(clock=lambda: now[0])
+        now[0] = 1.0
+        profile.enter('auth')
+        now[0] = 1.5
+        profile.enter('jwks')
+        now[0] = 3.5
+        profile.exit()
+        profile.exit()
+        now[0] = 4.0
+        profile.enter('db')
+        now[0] = 7.0
+        profile.exit()
+
+        self.assertEqual(profile.finish(), 7.0)
+        self.assertEqual(dict(profile.phases), {'view': 1.5, 'auth': 0.5, 'jwks': 2.0, 'db': 3.0})
+
+    def test_metrics_endpoint(self):
+        client = self.make_client(PROFILING_ENABLED=True, INTERNAL_ENDPOINTS=True)
+        headers = {'Authorization': 'Bearer executive'}
+        res = client.get('/artists?include=albums', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        timings = dict(entry.split(';dur=') for entry in res.headers['Server-Timing'].split(', '))
+        self.assertTrue({'auth', 'db', 'serialize', 'view', 'total'} <= set(timings))
+
+        client.post('/artists', json={'name': 'Profiled', 'age': 30, 'genre': 'Jazz', 'country': 'US'},
+                    headers=headers)
+        client.get('/artists')
+
+        res = client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        metrics = res.data.decode()
+        self.assertIn('http_requests_total{method="GET",route="/artists",status="200"} 1', metrics)
+        self.assertIn('http_requests_total{method="GET",route="/artists",status="401"} 1', metrics)
+        self.assertIn('http_request_duration_seconds_count{method="POST",route="/artists"} 1', metrics)
+        self.assertIn('http_request_phase_seconds_total{method="GET",route="/artists",phase="serialize"}',
+                      metrics)
+        # the rejected request ran no SQL; the page (version, artists, albums) a few statements
+        self.assertIn('http_request_sql_statements_bucket{method="GET",route="/artists",le="0"} 1', metrics)
+        self.assertIn('http_request_sql_statements_bucket{method="GET",route="/artists",le="5"} 2', metrics)
+        # the INSERT reports its row; the pages count the rows they read, though sqlite reports none
+        counters = dict(line.rsplit(' ', 1) for line in metrics.splitlines()
+                        if line.startswith('http_request_sql_rows'))
+        self.assertGreaterEqual(int(counters['http_request_sql_rows_written_total{method="POST",route="/artists"}']), 1)
+        self.assertEqual(counters['http_request_sql_rows_written_total{method="GET",route="/artists"}'], '0')
+        self.assertGreater(int(counters['http_request_sql_rows_read_total{method="GET",route="/artists"}']), 0)
+        self.assertIn('db_pool_checkouts_total', metrics)
+        self.assertNotIn('route="/metrics"', metrics)
+
+    def test_metrics_endpoint_is_internal(self):
+        client = self.make_client(PROFILING_ENABLED=True, INTERNAL_ENDPOINTS=False)
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        # the phases still reach the Server-Timing header
+        res = client.get('/artists', headers={'Authorization': 'Bearer assistant'})
+        self.assertIn('Server-Timing', res.headers)
+
+    def test_disabled_by_default(self):
+        client = self.make_client()
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        res = client.get('/artists', headers={'Authorization': 'Bearer assistant'})
+        self.assertNotIn('Server-Timing', res.headers)
+
+    def test_sampler_dumps_every_nth_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            client = self.make_client(PROFILE_SAMPLE_EVERY=2, PROFILE_DIR=directory)
+            for _ in range(5):
+                client.get('/albums', headers={'Authorization': 'Bearer assistant'})
+            dumps = sorted(os.listdir(directory))
+
+            self.assertEqual(len(dumps), 2)
+            self.assertTrue(all(name.endswith('-GET-albums-%d.prof' % n) for name, n in zip(dumps, (2, 4))))
+
+
+class SlowQueryLogTestCase(unittest.TestCase):
+    """Slow statements are kept with redacted parameters, route and plan"""
+
+    def test_endpoint_lists_slow_statements(self):
+        app = create_app({'INTERNAL_ENDPOINTS': True, 'SLOW_QUERY_MS': 0, 'RESPONSE_CACHE_ENABLED': False})
+        setup_db(app, "sqlite:///test.db")
+        client = app.test_client()
+        client.get('/artists?genre=Rock&name_prefix=Ab&limit=5', headers={'Authorization': 'Bearer assistant'})
+        log = json.loads(client.get('/internal/slow-queries').data)['slow_queries']
+
+        self.assertEqual(log['threshold_ms'], 0)
+        entry = next(entry for entry in log['entries']
+                     if entry['statement'].startswith('SELECT artists.id'))
+        self.assertEqual(entry['route'], 'GET /artists')
+        self.assertEqual(entry['parameters'][:2], ['<redacted>', '<redacted>'])
+        self.assertIsInstance(entry['parameters'][2], int)
+        self.assertTrue(any('ix_artists_genre_country' in line for line in entry['plan']))
+        self.assertEqual(create_app().test_client().get('/internal/slow-queries').status_code, 404)
+
+    def test_threshold_and_ring_buffer(self):
+        engine = create_engine('sqlite://')
+        fast = slowqueries.SlowQueryLog(threshold_ms=60000)
+        slow = slowqueries.SlowQueryLog(threshold_ms=0, size=3)
+        fast.listen(engine)
+        slow.listen(engine)
+        slow.listen(engine)
+        with engine.connect() as connection:
+            for n in range(5):
+                connection.exec_driver_sql('SELECT ?', (n,))
+
+        self.assertEqual(fast.count, 0)
+        self.assertEqual(slow.count, 5)
+        self.assertEqual([entry['parameters'] for entry in slow.entries()], [[4], [3], [2]])
+        self.assertIsNone(slow.entries()[0]['route'])
+
+    def test_redact(self):
+        self.assertEqual(slowqueries.redact({'name': 'Ab%', 'age': 30, 'day': datetime(2020, 1, 2)}),
+                         {'name': '<redacted>', 'age': 30, 'day': '2020-01-02T00:00:00'})
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Reads go to the replica, writes and a client's reads right after its writes to the primary"""
+
+    replica_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replica_test.db')
+
+    def setUp(self):
+        self.app = create_app({'DATABASE_REPLICA_URLS': f'sqlite:///{self.replica_path}',
+                               'RESPONSE_CACHE_ENABLED': False})
+        setup_db(self.app, "sqlite:///test.db")
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer director'}
+
+        # A second, independent database stands in for the replica
+        replica = self.app.extensions['db_replicas'][0]
+        db.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Artist.__table__.delete())
+            connection.execute(Artist.__table__.insert(), {
+                'id': 900001, 'name': 'Replica Only', 'age': 40, 'genre': 'Rock', 'country': 'UK'
+            })
+
+    def tearDown(self):
+        self.app.extensions['db_replicas'][0].dispose()
+        os.remove(self.replica_path)
+
+    def test_reads_use_replica(self):
+        res = self.client.get('/artists/900001', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['artist']['name'], 'Replica Only')
+
+    def test_client_reads_its_writes_from_primary(self):
+        # a bearer-token client that keeps no cookies
+        self.client = self.app.test_client(use_cookies=False)
+        res = self.client.post('/artists', json={'name': 'Primary Artist', 'age': 30, 'genre': 'Pop',
+                                                 'country': 'USA'}, headers=self.headers)
+        artist_id = json.loads(res.data)['created']
+        self.assertIn(replicas.STICKY_COOKIE, res.headers['Set-Cookie'])
+
+        self.assertEqual(self.client.get(f'/artists/{artist_id}', headers=self.headers).status_code, 200)
+        self.assertEqual(self.client.get('/artists/900001', headers=self.headers).status_code, 404)
+
+        # other clients keep reading from the replica
+        other = {'Authorization': 'Bearer assistant'}
+        self.assertEqual(self.client.get('/artists/900001', headers=other).status_code, 200)
+
+        # Once the window is over reads go back to the replica
+        self.app.extensions['replica_sticky'].clear()
+        self.assertEqual(self.client.get(f'/artists/{artist_id}', headers=self.headers).status_code, 404)
+        self.assertEqual(self.client.get('/artists/900001', headers=self.headers).status_code, 200)
+
+    def test_sticky_window_expires(self):
+        now = [0.0]
+        store = replicas.MemoryStickyStore(maxsize=2, clock=lambda: now[0])
+        store.stick('a', 5)
+        store.stick('b', 5)
+        store.stick('c', 5)
+        self.assertEqual([store.is_sticky(client) for client in 'abc'], [False, True, True])
+        now[0] = 5.0
+        self.assertFalse(store.is_sticky('b'))
+
+    def test_cookie_keeps_browsers_on_primary(self):
+        res = self.client.post('/artists', json={'name': 'Cookie Artist', 'age': 30, 'genre': 'Pop',
+                                                 'country': 'USA'}, headers=self.headers)
+        artist_id = json.loads(res.data)['created']
+        self.app.extensions['replica_sticky'].clear()
+        self.assertEqual(self.client.get(f'/artists/{artist_id}', headers=self.headers).status_code, 200)
+
+    def test_no_replicas_by_default(self):
+        app = create_app()
+        setup_db(app, "sqlite:///test.db")
+        self.assertNotIn('db_replicas', app.extensions)
+        res = app.test_client().post('/artists', json={'name': 'No Replica', 'age': 30, 'genre': 'Pop',
+                                                       'country': 'USA'}, headers=self.headers)
+        self.assertNotIn('Set-Cookie', res.headers)
+
+
+@unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'aiosqlite is not installed')
+class AsyncAPITestCase(unittest.TestCase):
+    """The ASGI entry point serves the Flask routes with async database I/O"""
+
+    def setUp(self):
+        from asgi import AsyncAPI
+        self.app = create_app({'RESPONSE_CACHE_ENABLED': False})
+        setup_db(self.app, "sqlite:///test.db")
+        self.api = AsyncAPI(self.app)
+        self.headers = {'Authorization': 'Bearer director'}
+
+    async def request(self, method, path, headers=None, body=None):
+        path, _, query = path.partition('?')
+        headers = dict(headers or {})
+        data = b''
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+                 'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()]}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': data}
+
+        async def send(message):
+            messages.append(message)
+
+        await self.api(scope, receive, send)
+        return messages[0]['status'], json.loads(b''.join(message.get('body', b'') for message in messages[1:]))
+
+    def run_requests(self, *requests):
+        async def run():
+            try:
+                return await asyncio.gather(*requests)
+            finally:
+                # pooled aiosqlite connections belong to this event loop
+                await self.api.engine.dispose()
+        return asyncio.run(run())
+
+    def test_same_responses_as_wsgi_app(self):
+        client = self.app.test_client()
+
+        results = self.run_requests(
+            self.request('GET', '/albums?limit=3', self.headers),
+            self.request('GET', '/artists/999999', self.headers),
+            self.request('GET', '/artists'))
+        for (status, data), path, headers in zip(results, ['/albums?limit=3', '/artists/999999', '/artists'],
+                                                 [self.headers, self.headers, {}]):
+            res = client.get(path, headers=headers)
+            self.assertEqual((status, data), (res.status_code, json.loads(res.data)))
+        self.assertEqual(results[2][0], 401)
+
+    def test_queries_use_async_engine(self):
+        with self.app.app_context():
+            sync_engine = db.engine
+        with count_queries(self.api.engine.sync_engine) as async_statements:
+            with count_queries(sync_engine) as sync_statements:
+                [(status, data)] = self.run_requests(self.request('POST', '/artists', self.headers, {
+                    'name': 'Async Artist', 'age': 30, 'genre': 'Pop', 'country': 'USA'}))
+                artist_id = data['created']
+                [(status, data)] = self.run_requests(self.request('GET', f'/artists/{artist_id}', self.headers))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['artist']['name'], 'Async Artist')
+        self.assertGreater(len(async_statements), 0)
+        self.assertEqual(sync_statements, [])
+
+
+class GunicornConfigTestCase(unittest.TestCase):
+    """gunicorn.conf.py settings"""
+
+    def load_config(self, **env):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+        spec = importlib.util.spec_from_file_location('gunicorn_conf', path)
+        config = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(os.environ, env):
+            spec.loader.exec_module(config)
+        return config
+
+    def test_settings_from_environment(self):
+        config = self.load_config(WEB_CONCURRENCY='3', GUNICORN_THREADS='2', PORT='5005')
+
+        self.assertEqual((config.workers, config.threads, config.worker_class), (3, 2, 'gthread'))
+        self.assertEqual(config.bind, '0.0.0.0:5005')
+        self.assertTrue(config.preload_app)
+        self.assertGreater(config.max_requests_jitter, 0)
+        self.assertLess(config.graceful_timeout, 30)
+
+    def test_single_thread_uses_sync_workers(self):
+        config = self.load_config(GUNICORN_THREADS='1')
+        self.assertEqual(config.worker_class, 'sync')
+
+
+class StartupTestCase(unittest.TestCase):
+    """Importing the app is side-effect free; init_db.py owns the schema"""
+
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    def run_python(self, code, database_path):
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{database_path}')
+        env.pop('DB_CREATE_SCHEMA', None)
+        return subprocess.run([sys.executable, '-c', code], cwd=self.root, env=env,
+                              capture_output=True, text=True, check=True).stdout
+
+    def scratch_path(self, name):
+        path = os.path.join(self.root, name)
+        self.addCleanup(lambda: os.path.exists(path) and os.remove(path))
+        return path
+
+    def test_import_does_not_build_app_or_touch_database(self):
+        path = self.scratch_path('startup_test.db')
+        out = self.run_python("import sys, app, asgi; print(app._app, asgi._api, 'jose' in sys.modules)", path)
+
+        self.assertEqual(out.split(), ['None', 'None', 'False'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_setup_db_leaves_schema_alone_by_default(self):
+        path = self.scratch_path('startup_test.db')
+        out = self.run_python('from sqlalchemy import inspect\n'
+                              'from app import APP\n'
+                              'from models import db\n'
+                              'with APP.app_context(): print(inspect(db.engine).get_table_names())', path)
+        self.assertEqual(out.strip(), '[]')
+
+    def test_init_db_creates_and_stamps_schema(self):
+        path = self.scratch_path('startup_test.db')
+        self.run_python('import init_db; init_db.init_database(); init_db.init_database()', path)
+
+        engine = create_engine(f'sqlite:///{path}')
+        with engine.connect() as connection:
+            tables = set(inspect(connection).get_table_names())
+            revision = connection.exec_driver_sql('SELECT version_num FROM alembic_version').scalar()
+        engine.dispose()
+        self.assertLessEqual({'artists', 'albums', 'artists_fts', 'catalog_revisions', 'catalog_stats'}, tables)
+        migrations = [name for name in os.listdir(os.path.join(self.root, 'migrations', 'versions'))
+                      if name.endswith('.py')]
+        self.assertEqual(revision, max(migrations)[:4])
+
+    def test_init_db_upgrades_legacy_schema(self):
+        # tables created by app startup before the migrations existed
+        path = self.scratch_path('startup_test.db')
+        engine = create_engine(f'sqlite:///{path}')
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                'CREATE TABLE artists (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(120) NOT NULL, '
+                'age INTEGER NOT NULL, genre VARCHAR(50) NOT NULL, country VARCHAR(50) NOT NULL)')
+            connection.exec_driver_sql(
+                'CREATE TABLE albums (id INTEGER NOT NULL PRIMARY KEY, title VARCHAR(120) NOT NULL, '
+                'release_date DATETIME NOT NULL, genre VARCHAR(50) NOT NULL, track_count INTEGER NOT NULL, '
+                'artist_id INTEGER NOT NULL REFERENCES artists (id))')
+            connection.exec_driver_sql("INSERT INTO artists VALUES (1, 'Legacy Singer', 40, 'Jazz', 'USA')")
+            connection.exec_driver_sql(
+                "INSERT INTO albums VALUES (1, 'Old Songs', '2001-01-01 00:00:00.000000', 'Jazz', 9, 1)")
+
+        self.run_python('import init_db; init_db.init_database(); init_db.init_database()', path)
+
+        with engine.connect() as connection:
+            inspector = inspect(connection)
+            tables = set(inspector.get_table_names())
+            indexes = {index['name'] for index in inspector.get_indexes('artists')}
+            revision = connection.exec_driver_sql('SELECT version_num FROM alembic_version').scalar()
+            matches = connection.exec_driver_sql(
+                "SELECT rowid FROM artists_fts WHERE artists_fts MATCH 'legacy'").fetchall()
+            artists = connection.exec_driver_sql(
+                "SELECT value FROM catalog_stats WHERE metric = 'totals' AND key = 'artists'").scalar()
+        engine.dispose()
+        self.assertLessEqual({'albums_fts', 'artists_fts', 'catalog_revisions', 'catalog_stats'}, tables)
+        self.assertLessEqual({'ix_artists_country', 'ix_artists_genre_country'}, indexes)
+        self.assertEqual(matches, [(1,)])
+        self.assertEqual(artists, 1)
+        migrations = [name for name in os.listdir(os.path.join(self.root, 'migrations', 'versions'))
+                      if name.endswith('.py')]
+        self.assertEqual(revision, max(migrations)[:4])
+
+
+class SeedingTestCase(unittest.TestCase):
+    """The synthetic seeder is deterministic and leaves the catalog consistent"""
+
+    def seeded_rows(self, path, runs=1):
+        app = create_app({'RESPONSE_CACHE_ENABLED': False})
+        setup_db(app, f'sqlite:///{path}')
+        with app.app_context():
+            for _ in range(runs):
+                seeding.seed_catalog(40, 300, seed=5, batch_size=64)
+            rows = (db.session.query(Artist.id, Artist.name, Artist.age, Artist.genre, Artist.country)
+                    .order_by(Artist.id).all(),
+                    db.session.query(Album.id, Album.title, Album.release_date, Album.genre,
+                                     Album.track_count, Album.artist_id).order_by(Album.id).all())
+            db.session.remove()
+        return app, rows
+
+    def test_same_seed_same_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _, first = self.seeded_rows(os.path.join(directory, 'a.db'))
+            _, second = self.seeded_rows(os.path.join(directory, 'b.db'))
+
+        self.assertEqual(first, second)
+        artists, albums = first
+        self.assertEqual((len(artists), len(albums)), (40, 300))
+        self.assertEqual({album.artist_id for album in albums} - {artist.id for artist in artists}, set())
+        self.assertTrue(all(isinstance(album.release_date, datetime) for album in albums))
+
+    def test_catalog_stays_consistent(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app, (artists, albums) = self.seeded_rows(os.path.join(directory, 'catalog.db'), runs=2)
+            with app.app_context():
+                totals = get_stats()['totals']
+                triggers = [row[0] for row in db.session.execute(
+                    text("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%fts_ai'"))]
+                matches = db.session.execute(
+                    text("SELECT COUNT(*) FROM albums_fts WHERE albums_fts MATCH :word"),
+                    {'word': albums[-1].title.split()[0]}).scalar()
+                db.session.remove()
+
+        # a second run appends after the existing ids
+        self.assertEqual([artist.id for artist in artists], list(range(1, 81)))
+        self.assertEqual((totals['artists'], totals['albums']), (80, 600))
+        self.assertEqual(totals['tracks'], sum(album.track_count for album in albums))
+        self.assertEqual(sorted(triggers), ['albums_fts_ai', 'artists_fts_ai'])
+        self.assertGreater(matches, 0)
+
+    def test_copy_stream(self):
+        rows = iter([(1, 'Tab\there', datetime(2020, 1, 2)), (2, 'Back\\slash', None)])
+        self.assertEqual(seeding.CopyStream(rows).read(),
+                         b'1\tTab\\there\t2020-01-02 00:00:00\n2\tBack\\\\slash\t\\N\n')
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    """ETags and If-None-Match on the list endpoints"""
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, "sqlite:///test.db")
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer executive'}
+
+    def test_matching_etag_returns_304_without_listing(self):
+        first = self.client.get('/albums', headers=self.headers)
+        etag = first.headers['ETag']
+        with self.app.app_context():
+            with count_queries(db.engine) as statements:
+                res = self.client.get('/albums', headers=dict(self.headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+
+    def test_write_changes_etag(self):
+        etag = self.client.get('/artists', headers=self.headers).headers['ETag']
+        self.client.post('/artists', json={'name': 'ETag Artist', 'age': 30, 'genre': 'Pop', 'country': 'USA'},
+                         headers=self.headers)
+        res = self.client.get('/artists', headers=dict(self.headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_etag_depends_on_query_string(self):
+        first = self.client.get('/artists?limit=1', headers=self.headers).headers['ETag']
+        second = self.client.get('/artists?limit=2', headers=self.headers).headers['ETag']
+
+        self.assertNotEqual(first, second)
+
+    def test_bulk_write_bumps_revision(self):
+        with self.app.app_context():
+            before = catalog_version('artists', 'albums')
+        res = self.client.post('/artists/bulk', json={'artists': [
+            {'name': 'Revision Artist', 'age': 30, 'genre': 'Pop', 'country': 'USA'}]}, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertNotEqual(catalog_version('artists', 'albums'), before)
+
+    def test_conditional_get_still_requires_auth(self):
+        etag = self.client.get('/albums', headers=self.headers).headers['ETag']
+        res = self.client.get('/albums', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 401)
+
+
+class SearchTestCase(unittest.TestCase):
+    """GET /search full-text search"""
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, "sqlite:///test.db")
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer executive'}
+        self.tag = f'zq{time.time_ns()}'
+
+    def search(self, **params):
+        res = self.client.get('/search', query_string=params, headers=self.headers)
+        return res, json.loads(res.data)
+
+    def create(self, name, *titles):
+        res = self.client.post('/artists', json={'name': name, 'age': 30, 'genre': 'Pop', 'country': 'USA'},
+                               headers=self.headers)
+        artist_id = json.loads(res.data)['created']
+        album_ids = []
+        for title in titles:
+            album = {'title': title, 'release_date': '2024-01-01', 'genre': 'Pop', 'artist_id': artist_id}
+            album_ids.append(json.loads(self.client.post('/albums', json=album, headers=self.headers).data)['created'])
+        return artist_id, album_ids
+
+    def test_prefix_search_over_names_and_titles(self):
+        artist_id, album_ids = self.create(f'{self.tag} Swift', f'{self.tag} Midnights', 'Unrelated')
+        res, data = self.search(q=f'{self.tag[:-2]}')
+
+        self.assertEqual(res.status_code, 200)
+        found = {(result['type'], result['id']) for result in data['results']}
+        self.assertEqual(found, {('artist', artist_id), ('album', album_ids[0])})
+
+    def test_all_terms_must_match(self):
+        artist_id, album_ids = self.create(f'{self.tag} Swift', f'{self.tag} Midnights')
+        res, data = self.search(q=f'{self.tag} midn', type='albums')
+
+        self.assertEqual([result['id'] for result in data['results']], [album_ids[0]])
+
+    def test_index_follows_updates_and_deletes(self):
+        artist_id, _ = self.create(f'{self.tag} Before')
+        self.client.patch(f'/artists/{artist_id}', json={'name': f'{self.tag} After'}, headers=self.headers)
+        self.assertEqual(self.search(q=f'{self.tag} before')[1]['results'], [])
+        self.assertEqual(len(self.search(q=f'{self.tag} after')[1]['results']), 1)
+
+        self.client.delete('/artists/bulk', json={'ids': [artist_id]}, headers=self.headers)
+        self.assertEqual(self.search(q=self.tag)[1]['results'], [])
+
+    def test_results_are_paginated(self):
+        for n in range(3):
+            self.create(f'{self.tag} Artist{n}')
+        first = self.search(q=self.tag, limit=2)[1]
+        second = self.search(q=self.tag, limit=2, page=2)[1]
+
+        self.assertEqual(len(first['results']), 2)
+        self.assertEqual(first['next_page'], 2)
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next_page'])
+
+    def test_search_requires_query(self):
+        res, data = self.search(q='  %% ')
+
+        self.assertEqual(res.status_code, 400)
+
+
+class CatalogStatsTestCase(unittest.TestCase):
+    """GET /stats and the incrementally maintained counters"""
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, "sqlite:///test.db")
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer executive'}
+        self.genre = f'Stats{time.time_ns()}'
+
+    def reconciled(self):
+        with self.app.app_context():
+            reconcile_stats()
+            stats = get_stats()
+            db.session.rollback()
+        return stats
+
+    def stats(self):
+        res = self.client.get('/stats', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        return {key: data[key] for key in ('totals', 'artists_by_genre', 'artists_by_country', 'albums_by_genre')}
+
+    def test_counters_follow_writes(self):
+        res = self.client.post('/artists', json={'name': 'Stats Artist', 'age': 30, 'genre': self.genre,
+                                                 'country': 'Iceland'}, headers=self.headers)
+        artist_id = json.loads(res.data)['created']
+        album = {'title': 'Stats Album', 'release_date': '2024-01-01', 'genre': self.genre,
+                 'track_count': 7, 'artist_id': artist_id}
+        album_ids = [json.loads(self.client.post('/albums', json=album, headers=self.headers).data)['created']
+                     for _ in range(3)]
+        self.assertEqual(self.stats()['albums_by_genre'][self.genre], 3)
+
+        self.client.patch(f'/albums/{album_ids[0]}', json={'genre': 'Other', 'track_count': 9}, headers=self.headers)
+        self.client.delete(f'/albums/{album_ids[1]}', headers=self.headers)
+        self.client.patch(f'/artists/{artist_id}', json={'country': 'Norway'}, headers=self.headers)
+        self.client.post('/albums/bulk', json={'albums': [album, album]}, headers=self.headers)
+        self.client.patch('/albums/bulk', json={'ids': album_ids[2:], 'changes': {'track_count': 1}},
+                          headers=self.headers)
+
+        stats = self.stats()
+        self.assertEqual(stats['albums_by_genre'][self.genre], 3)
+        self.assertEqual(stats['artists_by_genre'][self.genre], 1)
+        self.assertEqual(stats, self.reconciled())
+
+        self.client.delete(f'/artists/{artist_id}', headers=self.headers)
+        stats = self.stats()
+        self.assertNotIn(self.genre, stats['albums_by_genre'])
+        self.assertEqual(stats, self.reconciled())
+
+    def test_bulk_writes_apply_deltas(self):
+        artists = [{'name': f'Bulk Stats {n}', 'age': 30, 'genre': self.genre, 'country': 'Chile'}
+                   for n in range(3)]
+        self.client.post('/artists/bulk', json={'artists': artists}, headers=self.headers)
+        with self.app.app_context():
+            artist_ids = [artist.id for artist in Artist.query.filter(Artist.genre == self.genre)]
+        album = {'title': 'Bulk Stats Album', 'release_date': '2024-01-01', 'genre': self.genre,
+                 'track_count': 5, 'artist_id': artist_ids[0]}
+        self.client.post('/albums/bulk', json={'albums': [album, dict(album, track_count=8)]},
+                         headers=self.headers)
+
+        with self.app.app_context():
+            with count_queries(db.engine) as statements:
+                responses = [
+                    self.client.patch('/artists/bulk', json={'filter': {'genre': self.genre},
+                                                             'changes': {'country': 'Peru'}}, headers=self.headers),
+                    self.client.patch('/albums/bulk', json={'filter': {'genre': self.genre},
+                                                            'changes': {'genre': 'Other', 'track_count': 2}},
+                                      headers=self.headers),
+                    self.client.delete('/artists/bulk', json={'ids': artist_ids[:2]}, headers=self.headers)
+                ]
+        self.assertEqual([res.status_code for res in responses], [200, 200, 200])
+        # no recount of the catalog
+        self.assertFalse(any(statement.startswith('DELETE FROM catalog_stats') for statement in statements))
+
+        stats = self.stats()
+        self.assertEqual(stats['artists_by_genre'][self.genre], 1)
+        self.assertNotIn(self.genre, stats['albums_by_genre'])
+        self.assertEqual(stats, self.reconciled())
+
+    def test_counters_are_upserted(self):
+        with self.app.app_context():
+            self.assertIsNotNone(db.session.get(CatalogRevision, 'catalog_stats'))
+            with count_queries(db.engine) as statements:
+                for _ in range(2):
+                    commit_write('catalog_stats', stats={('albums_by_genre', self.genre): 2})
+            self.assertEqual(db.session.get(CatalogStat, ('albums_by_genre', self.genre)).value, 4)
+            # one statement per counter, which creates the row or adds to it
+            writes = [statement for statement in statements if statement.startswith('INSERT')]
+            self.assertEqual(len(writes), 4)
+            self.assertTrue(all('ON CONFLICT' in statement for statement in writes))
+            commit_write('catalog_stats', stats={('albums_by_genre', self.genre): -4})
+
+    def test_stats_read_does_not_scan_catalog(self):
+        with self.app.app_context():
+            with count_queries(db.engine) as statements:
+                self.client.get('/stats', headers=self.headers)
+
+        self.assertFalse(any('FROM artists' in statement or 'FROM albums' in statement
+                             for statement in statements))
+
+    def test_reconcile_repairs_drift(self):
+        with self.app.app_context():
+            CatalogStat.query.filter(CatalogStat.metric == 'totals').update(
+                {CatalogStat.value: -1}, synchronize_session=False)
+            db.session.commit()
+        self.assertEqual(self.stats()['totals']['artists'], -1)
+
+        runner = self.app.test_cli_runner()
+        with self.app.app_context():
+            from manage import reconcile_stats_command
+            result = runner.invoke(reconcile_stats_command)
+        self.assertEqual(result.exit_code, 0)
+        self.assertGreaterEqual(self.stats()['totals']['artists'], 0)
+
+
+class SerializationTestCase(unittest.TestCase):
+    """JSON provider and tuple rows for the list endpoints"""
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, "sqlite:///test.db")
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer assistant'}
+        with self.app.app_context():
+            artist = Artist(name='Serialized Artist', age=41, genre='Jazz', country='France')
+            artist.insert()
+            album = Album(title='Serialized Album', release_date=datetime(2001, 2, 3),
+                          genre='Jazz', track_count=7, artist_id=artist.id)
+            album.insert()
+            self.artist_id, self.album_id = artist.id, album.id
+
+    def test_provider_writes_dates_as_days(self):
+        value = {'release_date': datetime(2001, 2, 3).date(), 'n': 1}
+        for use_orjson in (False, True):
+            if use_orjson and serialization.orjson is None:
+                continue
+            self.app.json.use_orjson = use_orjson
+            self.assertEqual(json.loads(self.app.json.dumps(value)), {'n': 1, 'release_date': '2001-02-03'})
+
+    def test_stdlib_and_orjson_bodies_match(self):
+        if serialization.orjson is None:
+            self.skipTest('orjson is not installed')
+        self.app.config['RESPONSE_CACHE_ENABLED'] = False
+        self.app.extensions.pop('response_cache', None)
+        bodies, calls = [], []
+        for use_orjson in (False, True):
+            self.app.json.use_orjson = use_orjson
+            with mock.patch.object(serialization.orjson, 'dumps', wraps=serialization.orjson.dumps) as dumps:
+                bodies.append(json.loads(self.client.get('/albums', headers=self.headers).data))
+            calls.append(dumps.call_count)
+        self.assertEqual(bodies[0], bodies[1])
+        # jsonify() responses are encoded by orjson, and only when it is on
+        self.assertEqual(calls, [0, 1])
+
+    def test_pretty_printing_uses_stdlib(self):
+        if serialization.orjson is None:
+            self.skipTest('orjson is not installed')
+        self.app.json.use_orjson = True
+        self.app.json.compact = False
+        with self.app.app_context(), \
+                mock.patch.object(serialization.orjson, 'dumps', wraps=serialization.orjson.dumps) as dumps:
+            body = self.app.json.response({'n': 1}).get_data(as_text=True)
+        self.assertEqual(body, '{\n  "n": 1\n}\n')
+        self.assertEqual(dumps.call_count, 0)
+
+    def test_tuple_rows_match_format(self):
+        cursor = pagination.encode_cursor(self.album_id - 1)
+        data = json.loads(self.client.get(f'/albums?limit=1&cursor={cursor}', headers=self.headers).data)
+        with self.app.app_context():
+            self.assertEqual(data['albums'], [db.session.get(Album, self.album_id).format()])
+
+    def test_compact_rows_embed_relationships(self):
+        cursor = pagination.encode_cursor(self.artist_id - 1)
+        path = f'/artists?limit=1&cursor={cursor}&format=compact&fields=name&include=albums'
+        data = json.loads(self.client.get(path, headers=self.headers).data)
+        self.assertEqual(data['columns'], ['name', 'albums'])
+        self.assertEqual(data['artists'], [['Serialized Artist', [{
+            'id': self.album_id, 'title': 'Serialized Album', 'release_date': '2001-02-03', 'genre': 'Jazz'
+        }]]])
+
+
+class RS256TestCase(unittest.TestCase):
+    """Base for tests that verify real RS256 tokens against a local JWKS server"""
+
+    @classmethod
+    def setUpClass(cls):
+        public_key, private_key = rsa.newkeys(1024)
+        cls.private_pem = private_key.save_pkcs1().decode()
+        cls.jwk = {
+            'kty': 'RSA',
+            'kid': 'test-key',
+            'use': 'sig',
+            'n': b64url_uint(public_key.n),
+            'e': b64url_uint(public_key.e)
+        }
+
+    def setUp(self):
+        self.server = JWKSServer({'keys': [self.jwk]})
+        self.now = [1000.0]
+        self.cache = auth.JWKSCache(url=self.server.url, ttl=60, backoff=10,
+                                    min_refresh_interval=5, clock=lambda: self.now[0])
+        self.original = (auth.jwks_cache, auth.token_cache, auth.AUTH0_DOMAIN, auth.API_AUDIENCE)
+        auth.jwks_cache = self.cache
+        auth.token_cache = auth.TokenCache(maxsize=4, max_ttl=60)
+        auth.AUTH0_DOMAIN = 'test.auth0.local'
+        auth.API_AUDIENCE = 'music-label-api'
+
+    def tearDown(self):
+        auth.jwks_cache, auth.token_cache, auth.AUTH0_DOMAIN, auth.API_AUDIENCE = self.original
+        self.server.close()
+
+    def make_token(self, kid='test-key', **claims):
+        payload = {
+            'iss': 'https://test.auth0.local/',
+            'aud': 'music-label-api',
+            'sub': 'auth0|tester',
+            'exp': int(time.time()) + 3600,
+            'permissions': ['get:artists']
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_pem, algorithm='RS256', headers={'kid': kid})
+
+
+class JWKSCacheTestCase(RS256TestCase):
+    """JWKS caching in auth.verify_decode_jwt"""
+
+    def test_keys_fetched_once_within_ttl(self):
+        for n in range(5):
+            payload = auth.verify_decode_jwt(self.make_token(jti=str(n)))
+        self.assertEqual(payload['sub'], 'auth0|tester')
+        self.assertEqual(self.server.requests, 1)
+
+    def test_keys_refetched_after_ttl(self):
+        self.cache.get_key('test-key')
+        self.now[0] += 61
+        self.assertTrue(self.cache.get_key('test-key'))
+        self.assertEqual(self.server.requests, 2)
+
+    def test_unknown_kid_forces_rate_limited_refresh(self):
+        self.cache.get_key('test-key')
+        # Within min_refresh_interval an unknown kid does not hit the server
+        self.assertIsNone(self.cache.get_key('rotated-key'))
+        self.assertEqual(self.server.requests, 1)
+
+        rotated = dict(self.jwk, kid='rotated-key')
+        self.server.jwks = {'keys': [self.jwk, rotated]}
+        self.now[0] += 6
+        self.assertEqual(self.cache.get_key('rotated-key')['kid'], 'rotated-key')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_failed_fetch_serves_stale_keys_and_backs_off(self):
+        self.cache.get_key('test-key')
+        self.server.fail = True
+        self.now[0] += 61
+        self.assertTrue(self.cache.get_key('test-key'))
+        self.assertTrue(self.cache.get_key('test-key'))
+        self.assertEqual(self.server.requests, 2)
+
+        self.server.fail = False
+        self.now[0] += 11
+        self.cache.get_key('test-key')
+        self.assertEqual(self.server.requests, 3)
+
+    def test_unavailable_jwks_without_cached_keys(self):
+        self.server.fail = True
+        with self.assertRaises(auth.AuthError) as ctx:
+            auth.verify_decode_jwt(self.make_token())
+        self.assertEqual(ctx.exception.status_code, 503)
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(self.make_token())
+        self.assertEqual(self.server.requests, 1)
+
+    def test_concurrent_refresh_is_single_flight(self):
+        self.cache.get_key('test-key')
+        self.now[0] += 61
+        threads = [threading.Thread(target=self.cache.get_key, args=('test-key',))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.requests, 2)
+
+
+class TokenCacheTestCase(RS256TestCase):
+    """Verified-token cache in auth.verify_decode_jwt"""
+
+    def test_repeated_token_skips_verification(self):
+        token = self.make_token()
+        first = auth.verify_decode_jwt(token)
+        second = auth.verify_decode_jwt(token)
+        self.assertIs(first, second)
+        self.assertEqual(auth.token_cache.stats()['hits'], 1)
+        self.assertEqual(auth.token_cache.stats()['misses'], 1)
+
+    def test_entry_expires_with_token(self):
+        now = [1000.0]
+        cache = auth.TokenCache(maxsize=4, max_ttl=60, clock=lambda: now[0])
+        cache.set('token', {'exp': 1010, 'sub': 'a'})
+        self.assertEqual(cache.get('token')['sub'], 'a')
+        now[0] = 1010
+        self.assertIsNone(cache.get('token'))
+
+    def test_expired_token_not_cached(self):
+        cache = auth.TokenCache(maxsize=4, max_ttl=60)
+        cache.set('token', {'exp': time.time() - 1})
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = auth.TokenCache(maxsize=2, max_ttl=60)
+        cache.set('a', {'sub': 'a'})
+        cache.set('b', {'sub': 'b'})
+        cache.get('a')
+        cache.set('c', {'sub': 'c'})
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_invalid_token_not_cached(self):
+        token = self.make_token(aud='someone-else')
+        for _ in range(2):
+            with self.assertRaises(auth.AuthError):
+                auth.verify_decode_jwt(token)
+        self.assertEqual(auth.token_cache.stats()['size'], 0)
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """Token buckets per client and permission, enforced in requires_auth"""
+
+    def make_client(self, **config):
+        app = create_app({'RESPONSE_CACHE_ENABLED': False, **config})
+        setup_db(app, "sqlite:///test.db")
+        return app.test_client()
+
+    def test_bucket_refills_over_time(self):
+        now = [0.0]
+        store = ratelimit.MemoryRateLimitStore(clock=lambda: now[0])
+        self.assertEqual(store.take('a', 0.5, 2), (True, 1, 2.0))
+        self.assertEqual(store.take('a', 0.5, 2), (True, 0, 4.0))
+        self.assertEqual(store.take('a', 0.5, 2), (False, 0, 2.0))
+        # other keys have their own bucket
+        self.assertTrue(store.take('b', 0.5, 2)[0])
+        now[0] = 2.0
+        self.assertEqual(store.take('a', 0.5, 2), (True, 0, 4.0))
+        now[0] = 100.0
+        self.assertEqual(store.take('a', 0.5, 2), (True, 1, 2.0))
+
+    def test_parse_budgets(self):
+        self.assertEqual(ratelimit.parse_budgets('get:albums=60/m, post:albums=10/30s:2, *=5/s'), {
+            'get:albums': (1.0, 60),
+            'post:albums': (10 / 30, 2),
+            '*': (5.0, 5)
+        })
+        self.assertEqual(ratelimit.parse_budgets(''), {})
+        for budget in ('get:albums=lots', 'get:albums=0/m', 'get:albums=60/0m', 'get:albums=60/m:0'):
+            with self.assertRaises(ValueError, msg=budget):
+                ratelimit.parse_budgets(budget)
+
+    def test_budget_per_client_and_permission(self):
+        client = self.make_client(RATE_LIMITS='get:albums=2/m, post:artists=1/h')
+        assistant = {'Authorization': 'Bearer assistant'}
+
+        res = client.get('/albums', headers=assistant)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['RateLimit-Limit'], '2')
+        self.assertEqual(res.headers['RateLimit-Remaining'], '1')
+        self.assertEqual(res.headers['RateLimit-Reset'], '30')
+        self.assertEqual(res.headers['RateLimit-Policy'], '2;w=60')
+        self.assertEqual(client.get('/albums', headers=assistant).headers['RateLimit-Remaining'], '0')
+
+        res = client.get('/albums', headers=assistant)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.get_json(), {'success': False, 'error': 429, 'message': 'too many requests'})
+        self.assertEqual(res.headers['Retry-After'], '30')
+        self.assertEqual(res.headers['RateLimit-Remaining'], '0')
+
+        # another client, and a permission without a budget, are not affected
+        self.assertEqual(client.get('/albums', headers={'Authorization': 'Bearer director'}).status_code, 200)
+        res = client.get('/artists', headers=assistant)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('RateLimit-Limit', res.headers)
+
+    def test_denied_request_spends_nothing(self):
+        client = self.make_client(RATE_LIMITS='*=5/m, get:albums=1/m')
+        assistant = {'Authorization': 'Bearer assistant'}
+        self.assertEqual(client.get('/albums', headers=assistant).status_code, 200)
+        for _ in range(3):
+            self.assertEqual(client.get('/albums', headers=assistant).status_code, 429)
+
+        # only the allowed request came out of the global budget
+        res = client.get('/artists', headers=assistant)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['RateLimit-Remaining'], '3')
+
+    def test_sub_is_the_client(self):
+        store = ratelimit.MemoryRateLimitStore()
+        client = self.make_client(RATE_LIMITS='*=1/m', RATE_LIMIT_STORE=store)
+        headers = {'Authorization': 'Bearer some.signed.token'}
+        with mock.patch.object(auth, 'verify_decode_jwt', return_value={'sub': 'auth0|42',
+                                                                        'permissions': ['get:artists']}):
+            self.assertEqual(client.get('/artists', headers=headers).status_code, 200)
+            self.assertEqual(client.get('/artists', headers=headers).status_code, 429)
+        self.assertEqual(list(store._buckets), ['auth0|42|*'])
+
+    def test_disabled_by_default(self):
+        client = self.make_client()
+        for _ in range(3):
+            res = client.get('/albums', headers={'Authorization': 'Bearer assistant'})
+            self.assertEqual(res.status_code, 200)
+        self.assertNotIn('RateLimit-Limit', res.headers)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()